@@ -1,6 +1,8 @@
 import math
+import numpy as np
 from geopy import distance
 from geopy import Point
+import shapely
 from shapely.geometry import LineString, Polygon
 #from geopy.distance import geodesic
 
@@ -142,12 +144,8 @@ print("Perimeter:", square.length)
     return sw_lat <= p_lat <= ne_lat and sw_lon <= p_lon <= ne_lon
 
 def find_bc_cell(grid_cells, cone_origin):
-    for idx in range(len(grid_cells)):
-        bbox = (grid_cells.iloc[idx]['southwest'][0], grid_cells.iloc[idx]['southwest'][1],
-                grid_cells.iloc[idx]['northeast'][0], grid_cells.iloc[idx]['northeast'][1])
-        
-        if is_point_in_bbox(cone_origin, bbox) == True:
-            return idx
+    # the spatial index only checks the cells around the origin, same result as a linear scan with is_point_in_bbox
+    return grid_cells.spatial_index().find_cell(cone_origin)
 
 ### ----- Grid extraction methods ----- ###
 
@@ -203,32 +201,131 @@ def check_bbox_points(grid_cell, cone_origin, cone_radius_m, cone_angle, cone_di
 
 # find all the indices encompassed by the cone
 def get_grids_subset(grid_cells, cone_origin, cone_radius_m, cone_angle, cone_direction):
-    grid_subset_idx = []
-    for idx in range(len(grid_cells)):
-        
-        # check if any of the points of the grid are inside the blue cone
-        grid_check = check_bbox_points(grid_cells.loc[idx], cone_origin, cone_radius_m, cone_angle, cone_direction)
-        if grid_check == True:
-            grid_subset_idx.append(idx)
-            
-    return grid_subset_idx
+    # only the cells near the cone reach the exact check
+    candidates = grid_cells.spatial_index().query_bbox(*get_cone_bounds(cone_origin, cone_radius_m, cone_angle, cone_direction))
+    grid_subset_idx = cone_coverage(grid_cells.northeast[candidates], grid_cells.southwest[candidates],
+                                    cone_origin, cone_radius_m, cone_angle, cone_direction)
+    return candidates[grid_subset_idx].tolist()
+
+### ----- Vectorized cone coverage ----- ###
+
+# Same checks as check_bbox_points, but for all grid cells in one pass. The geodesic
+# computations only depend on the cone, so they are done once per cone and not per point.
+
+def get_cone_constants(cone_center, cone_radius_m):
+    km_per_lat_degree = distance.distance((cone_center[0], cone_center[1]), (cone_center[0] + 1, cone_center[1])).km
+    km_per_lon_degree = distance.distance((cone_center[0], cone_center[1]), (cone_center[0], cone_center[1] + 1)).km
+
+    cone_radius_lat = cone_radius_m / 1000 / km_per_lat_degree
+    cone_radius_lon = cone_radius_m / 1000 / km_per_lon_degree
+
+    return cone_radius_lat, cone_radius_lon
+
+def get_cone_bounds(cone_origin, cone_radius_m, cone_angle, cone_direction):
+    # (min_lat, min_lon, max_lat, max_lon) that contains every cell cone_coverage can return:
+    # the radius box of the point check and the two cone edges
+    cone_radius_lat, cone_radius_lon = get_cone_constants(cone_origin, cone_radius_m)
+    p2, p3 = get_cone_segments(cone_origin, cone_radius_m, cone_angle, cone_direction)
+
+    lats = [cone_origin[0] - cone_radius_lat, cone_origin[0] + cone_radius_lat, p2[0], p3[0]]
+    lons = [cone_origin[1] - cone_radius_lon, cone_origin[1] + cone_radius_lon, p2[1], p3[1]]
+    return min(lats), min(lons), max(lats), max(lons)
+
+def compass_bearings(point, lats, lons):
+    # array version of calculate_initial_compass_bearing, from point to every (lats, lons)
+    lat1 = math.radians(point[0])
+    lat2 = np.radians(lats)
+
+    diffLong = np.radians(lons - point[1])
+
+    x = np.sin(diffLong) * np.cos(lat2)
+    y = math.cos(lat1) * np.sin(lat2) - (math.sin(lat1) * np.cos(lat2) * np.cos(diffLong))
+
+    initial_bearing = np.degrees(np.arctan2(x, y))
+    return (initial_bearing + 360) % 360
+
+def points_in_cone(lats, lons, cone_center, cone_radius_lat, cone_radius_lon, cone_angle, cone_direction):
+    # array version of is_point_in_cone, the radii come from get_cone_constants
+    inside = (np.abs(lats - cone_center[0]) <= cone_radius_lat) & (np.abs(lons - cone_center[1]) <= cone_radius_lon)
+
+    # bearings are only needed for the points inside the radius
+    candidates = np.flatnonzero(inside)
+    point_angle = (compass_bearings(cone_center, lats[candidates], lons[candidates]) + 360) % 360
+    cone_direction = (cone_direction + 360) % 360
+
+    start_angle = (cone_direction - cone_angle / 2 + 360) % 360
+    end_angle = (cone_direction + cone_angle / 2 + 360) % 360
+
+    if start_angle < end_angle:
+        in_angle = (start_angle <= point_angle) & (point_angle <= end_angle)
+    else:  # Cone crosses the 0/360 degree line
+        in_angle = (point_angle >= start_angle) | (point_angle <= end_angle)
+
+    inside[candidates] = in_angle
+    return inside
+
+def cone_coverage(northeast, southwest, cone_origin, cone_radius_m, cone_angle, cone_direction):
+    """
+    Returns the sorted indices of the grid cells that intersect the cone.
+
+    northeast and southwest are (n, 2) arrays of (lat, lon). A cell is covered when one of
+    its corners or its center is in the cone, or when one of the cone edges crosses it.
+    """
+    ne_lat, ne_lon = northeast[:, 0], northeast[:, 1]
+    sw_lat, sw_lon = southwest[:, 0], southwest[:, 1]
+
+    cone_radius_lat, cone_radius_lon = get_cone_constants(cone_origin, cone_radius_m)
+
+    # ne, nw, sw, se and center of every cell
+    bbox_points = [(ne_lat, ne_lon), (ne_lat, sw_lon), (sw_lat, sw_lon), (sw_lat, ne_lon),
+                   ((ne_lat + sw_lat) / 2, (ne_lon + sw_lon) / 2)]
+
+    covered = np.zeros(len(northeast), dtype=bool)
+    for lats, lons in bbox_points:
+        covered |= points_in_cone(lats, lons, cone_origin, cone_radius_lat, cone_radius_lon, cone_angle, cone_direction)
+
+    # check for intersections of grid edges with cone line segments
+    p1 = tuple(float(i) for i in cone_origin)
+    p2, p3 = get_cone_segments(cone_origin, cone_radius_m, cone_angle, cone_direction)
+
+    for point in [p2, p3]:
+        # only the cells overlapping the bounds of the segment can intersect it
+        candidates = np.flatnonzero(~covered
+                                    & (sw_lat <= max(p1[0], point[0])) & (ne_lat >= min(p1[0], point[0]))
+                                    & (sw_lon <= max(p1[1], point[1])) & (ne_lon >= min(p1[1], point[1])))
+        if len(candidates) == 0:
+            continue
+
+        line = LineString([p1, point])
+        shapely.prepare(line)
+        boxes = shapely.box(sw_lat[candidates], sw_lon[candidates], ne_lat[candidates], ne_lon[candidates])
+        covered[candidates[shapely.intersects(line, boxes)]] = True
+
+    return np.flatnonzero(covered)
+
+def cells_within_radius(northeast, southwest, cone_origin, cone_radius_m):
+    # cells that lie entirely within the radius (same lat/lon radius as is_point_in_cone), used to cut
+    # the inner part out of timing advance rings
+    cone_radius_lat, cone_radius_lon = get_cone_constants(cone_origin, cone_radius_m)
+    return ((np.abs(northeast[:, 0] - cone_origin[0]) <= cone_radius_lat) & (np.abs(southwest[:, 0] - cone_origin[0]) <= cone_radius_lat)
+            & (np.abs(northeast[:, 1] - cone_origin[1]) <= cone_radius_lon) & (np.abs(southwest[:, 1] - cone_origin[1]) <= cone_radius_lon))
 
 # return the bounding box coordinates of the grid subset
-def get_bbox_subset(grid_cells_subset):
-    grid_cells_subset = grid_cells_subset.reset_index()
-    
+def get_bbox_subset(grid_cells, grid_cells_idx):
+    grid_cells_idx = np.asarray(grid_cells_idx, dtype=np.int64)
+    grid_num = grid_cells.grid_num[grid_cells_idx].tolist()
+    ne = grid_cells.northeast[grid_cells_idx].tolist()
+    sw = grid_cells.southwest[grid_cells_idx].tolist()
+
     grid_subset = []
-    for grid in range(len(grid_cells_subset)):
-        ne = grid_cells_subset.loc[grid]['northeast']
-        sw = grid_cells_subset.loc[grid]['southwest']
-   
+    for grid in range(len(grid_cells_idx)):
         stage_coors = {
-            "grid_number": int(grid_cells_subset.loc[grid]['grid_num']),
-            "northeast": [float(i) for i in ne],
-            "southeast": [float(sw[0]), float(ne[1])],
-            "southwest": [float(i) for i in sw],
-            "northwest": [float(ne[0]), float(sw[1])],
+            "grid_number": int(grid_num[grid]),
+            "northeast": ne[grid],
+            "southeast": [sw[grid][0], ne[grid][1]],
+            "southwest": sw[grid],
+            "northwest": [ne[grid][0], sw[grid][1]],
         }
         grid_subset.append(stage_coors)
         
-    return grid_subset
\ No newline at end of file
+    return grid_subset
@@ -0,0 +1,53 @@
+import numpy as np
+
+# Sets of grid cells for combining several cones of one call. A cone coverage is a sorted array of
+# cell positions; to combine cones, the coverages become bitsets (one bit per cell), so intersections
+# and unions are word-wide AND/OR. The bitsets only span the positions the cones can share, not the
+# whole grid, so combining nearby cones stays cheap on large grids.
+
+MODES = ["intersection", "union", "counts"]
+
+def to_bitset(rows, start, size):
+    # bits of the positions start .. start + size - 1
+    bits = np.zeros(size, dtype=bool)
+    rows = np.asarray(rows, dtype=np.int64)
+    bits[rows[(rows >= start) & (rows < start + size)] - start] = True
+    return np.packbits(bits)
+
+def from_bitset(bitset, start, size):
+    # sorted cell positions of the set bits
+    return np.flatnonzero(np.unpackbits(bitset, count=size)) + start
+
+def as_arrays(row_sets):
+    return [np.asarray(rows, dtype=np.int64) for rows in row_sets if len(rows) > 0]
+
+def intersection(row_sets):
+    row_sets = [np.asarray(rows, dtype=np.int64) for rows in row_sets]
+    if len(row_sets) == 0 or any(len(rows) == 0 for rows in row_sets):
+        return np.zeros(0, dtype=np.int64)
+
+    start = max(int(rows.min()) for rows in row_sets)
+    stop = min(int(rows.max()) for rows in row_sets) + 1
+    if start >= stop:
+        return np.zeros(0, dtype=np.int64)
+    return from_bitset(np.bitwise_and.reduce([to_bitset(rows, start, stop - start) for rows in row_sets]), start, stop - start)
+
+def union(row_sets):
+    row_sets = as_arrays(row_sets)
+    if len(row_sets) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    start = min(int(rows.min()) for rows in row_sets)
+    stop = max(int(rows.max()) for rows in row_sets) + 1
+    return from_bitset(np.bitwise_or.reduce([to_bitset(rows, start, stop - start) for rows in row_sets]), start, stop - start)
+
+def overlap_counts(row_sets):
+    # sorted positions of the cells covered at least once and the number of sets covering them
+    row_sets = as_arrays(row_sets)
+    if len(row_sets) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    start = min(int(rows.min()) for rows in row_sets)
+    counts = np.bincount(np.concatenate([np.unique(rows) for rows in row_sets]) - start)
+    rows = np.flatnonzero(counts)
+    return rows + start, counts[rows]
@@ -0,0 +1,178 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import app.BlueConeCheck as bcc
+import app.Metrics as metrics
+
+# The same towers and sectors come up call after call, so the covered cells and the serialized
+# /bluecone answer are cached per cone. Cones are quantized (about 1 m for the origin, 1 m for the
+# radius and 0.1 degree for the angles) and computed from the quantized values, so an entry only
+# depends on its key and the dataset version.
+CONE_CACHE_SIZE = int(os.environ.get('GEOHILFE_CONE_CACHE_SIZE', 1024))
+
+# the answers of wide cones are large (about 220 bytes per cell), the cache is bounded in bytes as well
+CONE_CACHE_BYTES = int(os.environ.get('GEOHILFE_CONE_CACHE_BYTES', 64 * 1024 * 1024))
+
+# optional table of precomputed tower sectors (python -m app.ConeCache), loaded at startup
+CONE_TABLE_PATH = os.environ.get('GEOHILFE_CONE_TABLE', 'app/cone_table.json')
+
+ORIGIN_DECIMALS = 5
+ANGLE_DECIMALS = 1
+
+def cone_key(cone_origin, cone_radius_m, cone_angle, cone_direction):
+    return (round(float(cone_origin[0]), ORIGIN_DECIMALS), round(float(cone_origin[1]), ORIGIN_DECIMALS),
+            float(round(float(cone_radius_m))), round(float(cone_angle), ANGLE_DECIMALS),
+            round(float(cone_direction) % 360, ANGLE_DECIMALS))
+
+def cone_entry(grid_cells, key, origin_cell, rows):
+    # the /bluecone answer without the call_id is serialized once, the rows are kept as an int64 array
+    rows = np.asarray(rows, dtype=np.int64)
+    cone_origin = key[:2]
+    p2, p3 = bcc.get_cone_segments(cone_origin, *key[2:])
+    bluecone_points = [[float(i) for i in point] for point in [cone_origin, p2, p3]]
+    with metrics.stage('bbox_serialization'):
+        grids = bcc.get_bbox_subset(grid_cells, rows)
+        body = json.dumps({"bluecone_points": bluecone_points, "grids": grids}, ensure_ascii=False, separators=(',', ':'))
+
+    return {"origin_cell": origin_cell, "rows": rows, "bluecone_points": bluecone_points, "body": body.encode('utf-8')}
+
+def entry_nbytes(entry):
+    return len(entry["body"]) + entry["rows"].nbytes
+
+def compute_cone(grid_cells, key):
+    with metrics.stage('origin_lookup'):
+        origin_cell = bcc.find_bc_cell(grid_cells, key[:2])
+    with metrics.stage('cone_subset'):
+        rows = bcc.get_grids_subset(grid_cells, key[:2], *key[2:])
+    return cone_entry(grid_cells, key, origin_cell, rows)
+
+class ConeCache():
+    """
+    LRU cache of cone coverages: {"origin_cell": cell of the tower, "rows": covered cell positions,
+    "bluecone_points": the cone outline, "body": serialized answer}, bounded by max_size entries
+    and max_bytes. Cones only used by rows() are kept as {"rows": ..., "body": b""}. Entries of the precomputed tower table are kept apart and never evicted.
+    """
+    def __init__(self, max_size=CONE_CACHE_SIZE, max_bytes=CONE_CACHE_BYTES):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.precomputed = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries) + len(self.precomputed)
+
+    def get(self, grid_cells, cone_origin, cone_radius_m, cone_angle, cone_direction):
+        key = (grid_cells.version,) + cone_key(cone_origin, cone_radius_m, cone_angle, cone_direction)
+        with self.lock:
+            if key in self.precomputed:
+                metrics.CONE_CACHE.inc(result="precomputed")
+                return self.precomputed[key]
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                metrics.CONE_CACHE.inc(result="hit")
+                return self.entries[key]
+
+        # computed outside of the lock, two requests for the same new cone may both compute it
+        metrics.CONE_CACHE.inc(result="miss")
+        entry = compute_cone(grid_cells, key[1:])
+        with self.lock:
+            self._add(key, entry)
+        return entry
+
+    def rows(self, grid_cells, cone_origin, cone_radius_m, cone_angle, cone_direction):
+        # covered cell positions only (for combining cones), a new cone is not serialized
+        key = (grid_cells.version,) + cone_key(cone_origin, cone_radius_m, cone_angle, cone_direction)
+        rows_key = key + ('rows',)
+        with self.lock:
+            if key in self.precomputed:
+                metrics.CONE_CACHE.inc(result="precomputed")
+                return self.precomputed[key]["rows"]
+            for cached in [key, rows_key]:
+                if cached in self.entries:
+                    self.entries.move_to_end(cached)
+                    metrics.CONE_CACHE.inc(result="hit")
+                    return self.entries[cached]["rows"]
+
+        metrics.CONE_CACHE.inc(result="miss")
+        with metrics.stage('cone_subset'):
+            rows = np.asarray(bcc.get_grids_subset(grid_cells, key[1:3], *key[3:]), dtype=np.int64)
+        with self.lock:
+            self._add(rows_key, {"rows": rows, "body": b""})
+        return rows
+
+    def _add(self, key, entry):
+        # a cone larger than the whole budget is answered but not cached
+        nbytes = entry_nbytes(entry)
+        if nbytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.nbytes -= entry_nbytes(self.entries.pop(key))
+        self.entries[key] = entry
+        self.nbytes += nbytes
+        while len(self.entries) > self.max_size or self.nbytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= entry_nbytes(evicted)
+
+    def carry_over(self, previous_version, version):
+        # the coverage only depends on the geometry, a snapshot with updated cell names reuses it
+        # (the entries are shared, but counted for both versions)
+        with self.lock:
+            for key in [key for key in self.precomputed if key[0] == previous_version]:
+                self.precomputed[(version,) + key[1:]] = self.precomputed[key]
+            for key, entry in [(key, entry) for key, entry in self.entries.items() if key[0] == previous_version]:
+                self._add((version,) + key[1:], entry)
+
+    def load_table(self, grid_cells, path=CONE_TABLE_PATH):
+        # only the cones precomputed for the loaded dataset are used, returns their number
+        with open(path, encoding='utf-8') as f:
+            table = json.load(f)
+        if table["version"] != grid_cells.version:
+            return 0
+
+        precomputed = {}
+        for cone in table["cones"]:
+            key = tuple(cone["key"])
+            precomputed[(grid_cells.version,) + key] = cone_entry(grid_cells, key, cone["origin_cell"], cone["rows"])
+        with self.lock:
+            self.precomputed.update(precomputed)
+        return len(precomputed)
+
+def read_sectors(filename):
+    # csv with a header and the columns lat, lon, radius, angle, direction (one row per tower sector)
+    import csv
+
+    with open(filename, newline='', encoding='utf-8') as f:
+        return [((float(row['lat']), float(row['lon'])), float(row['radius']), float(row['angle']), float(row['direction']))
+                for row in csv.DictReader(f)]
+
+def precompute_cone_table(grid_cells, sectors, path=CONE_TABLE_PATH):
+    # offline coverage of known tower sectors for the dataset version of grid_cells
+    cones = []
+    for sector in sectors:
+        key = cone_key(*sector)
+        entry = compute_cone(grid_cells, key)
+        cones.append({"key": list(key), "origin_cell": entry["origin_cell"], "rows": entry["rows"].tolist()})
+
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"version": grid_cells.version, "cones": cones}, f)
+    return len(cones)
+
+if __name__ == '__main__':
+    import argparse
+    import app.GridStore as gs
+
+    parser = argparse.ArgumentParser(description='Precompute the cone coverage of known tower sectors.')
+    parser.add_argument('sectors', help='csv with the columns lat, lon, radius, angle, direction')
+    parser.add_argument('out', nargs='?', default=CONE_TABLE_PATH)
+    parser.add_argument('--grid', default=gs.GRID_PATH)
+    args = parser.parse_args()
+
+    grid_cells = gs.load_grid_store(args.grid)
+    count = precompute_cone_table(grid_cells, read_sectors(args.sectors), args.out)
+    print(f"{count} tower sectors written to {args.out} (dataset version {grid_cells.version})")
@@ -0,0 +1,72 @@
+import json
+import math
+
+import numpy as np
+
+# Compact answers of the API: the grid geometry is sent once per dataset version (GET /grid) and
+# /bluecone and /similarity only send grid numbers and scores. orjson is used when it is installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+RESPONSE_FORMATS = ["default", "compact", "binary"]
+
+def json_dumps(content):
+    # compact JSON as bytes, NaN scores have to be replaced with None first (see finite_or_none)
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+    # numpy arrays and scalars are converted with tolist()
+    return json.dumps(content, ensure_ascii=False, separators=(',', ':'), allow_nan=False,
+                      default=lambda value: value.tolist()).encode('utf-8')
+
+def finite_or_none(values):
+    return [value if math.isfinite(value) else None for value in values]
+
+def encode_scores(grid_numbers, scores):
+    """
+    Binary /similarity answer, little-endian: uint32 count, count int32 grid numbers and
+    count float32 scores (NaN for cells without a score).
+    """
+    grid_numbers = np.asarray(grid_numbers, dtype='<i4')
+    scores = np.asarray(scores, dtype='<f4')
+    return np.array([len(grid_numbers)], dtype='<u4').tobytes() + grid_numbers.tobytes() + scores.tobytes()
+
+def decode_scores(data):
+    count = int(np.frombuffer(data, dtype='<u4', count=1)[0])
+    grid_numbers = np.frombuffer(data, dtype='<i4', count=count, offset=4)
+    scores = np.frombuffer(data, dtype='<f4', count=count, offset=4 + 4 * count)
+    return grid_numbers, scores
+
+### ----- Grid geometry ----- ###
+
+def grid_geometry(grid_cells):
+    # parallel arrays of the cell bounds as (lat, lon), like the corners sent by /bluecone
+    return {
+        "dataset_version": grid_cells.version,
+        "grid_number": np.asarray(grid_cells.grid_num).tolist(),
+        "northeast": np.asarray(grid_cells.northeast).tolist(),
+        "southwest": np.asarray(grid_cells.southwest).tolist(),
+    }
+
+def grid_geojson(grid_cells):
+    # one polygon per cell, GeoJSON coordinates are (lon, lat) and exterior rings are counterclockwise
+    features = []
+    for grid_number, (ne_lat, ne_lon), (sw_lat, sw_lon) in zip(np.asarray(grid_cells.grid_num).tolist(),
+                                                                np.asarray(grid_cells.northeast).tolist(),
+                                                                np.asarray(grid_cells.southwest).tolist()):
+        ring = [[ne_lon, ne_lat], [sw_lon, ne_lat], [sw_lon, sw_lat], [ne_lon, sw_lat], [ne_lon, ne_lat]]
+        features.append({
+            "type": "Feature",
+            "id": grid_number,
+            "geometry": {"type": "Polygon", "coordinates": [ring]},
+            "properties": {"grid_number": grid_number},
+        })
+    return {"type": "FeatureCollection", "dataset_version": grid_cells.version, "features": features}
+
+def grid_geometry_body(grid_cells, geojson=False):
+    # serialized once per grid store, the answers only change with the dataset version
+    key = 'geojson' if geojson else 'geometry'
+    if key not in grid_cells.derived:
+        grid_cells.derived[key] = json_dumps(grid_geojson(grid_cells) if geojson else grid_geometry(grid_cells))
+    return grid_cells.derived[key]
@@ -0,0 +1,239 @@
+import hashlib
+import json
+import os
+from ast import literal_eval
+
+import numpy as np
+import pandas as pd
+
+import app.Metrics as metrics
+from app.SpatialIndex import GridHashIndex
+
+# The grid dataset used by the API. It can either be the original .csv file or a directory
+# created by convert_grid_csv() which is memory-mapped instead of parsed.
+GRID_PATH = os.environ.get('GEOHILFE_GRID_PATH', 'app/geohilfe_data_aws_v2.csv')
+
+LIST_COLUMNS = ["northeast", "southwest", "raw_data", "keywords", "addresses", "landmarks", "subregion", "streets"]
+
+# list columns that are kept as interned string tables, the rest of raw_data is not used by the API
+STRING_TABLES = ["keywords", "streets", "landmarks"]
+
+def read_grid_csv(filename):
+    # make sure that there are no nans in the csv
+    grid_cells = pd.read_csv(filename, sep='\t', converters={column: literal_eval for column in LIST_COLUMNS}).iloc[:, 1:]
+    return grid_cells
+
+class StringTable():
+    """
+    Interned strings of one list column (keywords, streets or landmarks).
+
+    Every distinct string is stored once in `names`, the strings of cell i are
+    names[indices[indptr[i]:indptr[i + 1]]] (CSR layout, duplicates and order are kept).
+    """
+    def __init__(self, names, indptr, indices):
+        self.names = names
+        self.indptr = indptr
+        self.indices = indices
+
+    @classmethod
+    def from_lists(cls, lists):
+        lookup = {}
+        names = []
+        indptr = np.zeros(len(lists) + 1, dtype=np.int64)
+        indices = []
+        for row, entries in enumerate(lists):
+            for entry in entries:
+                if entry not in lookup:
+                    lookup[entry] = len(names)
+                    names.append(entry)
+                indices.append(lookup[entry])
+            indptr[row + 1] = len(indices)
+
+        return cls(names, indptr, np.asarray(indices, dtype=np.int32))
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def cell(self, row):
+        return [self.names[i] for i in self.indices[self.indptr[row]:self.indptr[row + 1]]]
+
+    def counts(self):
+        return np.diff(self.indptr)
+
+    def take(self, rows):
+        # CSR of the selected rows only, the names table is shared
+        rows = np.asarray(rows, dtype=np.int64)
+        starts = self.indptr[rows]
+        counts = self.indptr[rows + 1] - starts
+        indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        positions = np.repeat(starts - indptr[:-1], counts) + np.arange(indptr[-1])
+        return StringTable(self.names, indptr, self.indices[positions])
+
+    def with_cells(self, cells):
+        """
+        Copy-on-write update: a new table where the rows of cells ({row: list of strings}) are replaced.
+        New strings are appended to a copy of the names, so the ids of the existing names stay the same.
+        """
+        names = list(self.names)
+        lookup = {name: i for i, name in enumerate(names)}
+        updated = {}
+        for row, entries in cells.items():
+            for entry in entries:
+                if entry not in lookup:
+                    lookup[entry] = len(names)
+                    names.append(entry)
+            updated[row] = [lookup[entry] for entry in entries]
+
+        counts = self.counts().copy()
+        for row, ids in updated.items():
+            counts[row] = len(ids)
+        indptr = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+
+        # the unchanged rows are copied in one go, then the updated rows are written
+        indices = np.empty(indptr[-1], dtype=self.indices.dtype)
+        kept = np.setdiff1d(np.arange(len(self)), np.fromiter(updated, dtype=np.int64, count=len(updated)))
+        kept_table = self.take(kept)
+        indices[np.repeat(indptr[kept] - kept_table.indptr[:-1], kept_table.counts()) + np.arange(len(kept_table.indices))] = kept_table.indices
+        for row, ids in updated.items():
+            indices[indptr[row]:indptr[row + 1]] = ids
+        return StringTable(names, indptr, indices)
+
+class GridStore():
+    """
+    Column store of the grid cells: bounds and centers as (n, 2) float arrays of (lat, lon)
+    and a StringTable for each of keywords, streets and landmarks. Rows are addressed by
+    position, the same way the original DataFrame was addressed with .loc/.iloc.
+    """
+    def __init__(self, grid_num, northeast, southwest, tables, version=None):
+        self.grid_num = grid_num
+        self.northeast = northeast
+        self.southwest = southwest
+        self.center = (northeast + southwest) / 2
+        self.keywords = tables["keywords"]
+        self.streets = tables["streets"]
+        self.landmarks = tables["landmarks"]
+        self.version = version
+        self._spatial_index = None
+
+        # artifacts the models build from this store once (embeddings, name dictionaries)
+        self.derived = {}
+
+    @classmethod
+    def from_dataframe(cls, grid_cells, version=None):
+        tables = {column: StringTable.from_lists(grid_cells[column].tolist()) for column in STRING_TABLES}
+        return cls(grid_cells['grid_num'].to_numpy(dtype=np.int64),
+                   np.array(grid_cells['northeast'].tolist(), dtype=np.float64).reshape(-1, 2),
+                   np.array(grid_cells['southwest'].tolist(), dtype=np.float64).reshape(-1, 2),
+                   tables, version)
+
+    def __len__(self):
+        return len(self.grid_num)
+
+    def spatial_index(self):
+        # built on first use, the API builds it at startup
+        if self._spatial_index is None:
+            self._spatial_index = GridHashIndex(self.northeast, self.southwest)
+        return self._spatial_index
+
+    def tables(self):
+        return {"keywords": self.keywords, "streets": self.streets, "landmarks": self.landmarks}
+
+    def with_cells(self, updates, version):
+        """
+        Copy-on-write snapshot with the string lists of some cells replaced, updates maps rows to
+        {"keywords": [...], "streets": [...], "landmarks": [...]} (columns that are not given stay).
+        The geometry and the spatial index are shared with this store, which is left unchanged.
+        """
+        tables = self.tables()
+        for column in STRING_TABLES:
+            cells = {row: update[column] for row, update in updates.items() if column in update}
+            if len(cells) > 0:
+                tables[column] = tables[column].with_cells(cells)
+
+        grid_store = GridStore(self.grid_num, self.northeast, self.southwest, tables, version)
+        grid_store._spatial_index = self._spatial_index
+        return grid_store
+
+    def cell(self, row):
+        # a single grid cell in the same shape as a row of the original DataFrame
+        return {
+            "grid_num": int(self.grid_num[row]),
+            "northeast": tuple(float(i) for i in self.northeast[row]),
+            "southwest": tuple(float(i) for i in self.southwest[row]),
+            "keywords": self.keywords.cell(row),
+            "streets": self.streets.cell(row),
+            "landmarks": self.landmarks.cell(row),
+        }
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'grid_num.npy'), np.ascontiguousarray(self.grid_num))
+        np.save(os.path.join(path, 'northeast.npy'), np.ascontiguousarray(self.northeast))
+        np.save(os.path.join(path, 'southwest.npy'), np.ascontiguousarray(self.southwest))
+
+        names = {}
+        for column, table in self.tables().items():
+            np.save(os.path.join(path, f'{column}_indptr.npy'), np.ascontiguousarray(table.indptr))
+            np.save(os.path.join(path, f'{column}_indices.npy'), np.ascontiguousarray(table.indices))
+            names[column] = list(table.names)
+
+        with open(os.path.join(path, 'names.json'), 'w', encoding='utf-8') as f:
+            json.dump(names, f, ensure_ascii=False)
+        with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({"version": self.version, "cells": len(self)}, f)
+
+    @classmethod
+    def open(cls, path):
+        # arrays are memory-mapped read-only, so several workers share the same pages
+        def load(name):
+            return np.load(os.path.join(path, name), mmap_mode='r')
+
+        with open(os.path.join(path, 'names.json'), encoding='utf-8') as f:
+            names = json.load(f)
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+
+        tables = {column: StringTable(names[column], load(f'{column}_indptr.npy'), load(f'{column}_indices.npy'))
+                  for column in STRING_TABLES}
+        return cls(load('grid_num.npy'), load('northeast.npy'), load('southwest.npy'), tables, meta['version'])
+
+def file_version(filename):
+    # the dataset version is derived from the content, so a rewritten file gets a new version
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()[:12]
+
+def load_grid_store(path=GRID_PATH):
+    with metrics.stage('grid_load'):
+        if os.path.isdir(path):
+            return GridStore.open(path)
+        return GridStore.from_dataframe(read_grid_csv(path), version=file_version(path))
+
+def convert_grid_csv(filename, path):
+    # offline conversion of the .csv dataset into the memory-mappable directory format
+    grid_store = load_grid_store(filename)
+    grid_store.save(path)
+    return grid_store
+
+_grid_stores = {}
+
+def get_grid_store(path=GRID_PATH):
+    # the dataset is parsed once per process and shared by the API and the models
+    if path not in _grid_stores:
+        _grid_stores[path] = load_grid_store(path)
+    return _grid_stores[path]
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert the grid .csv dataset into the memory-mapped grid store format.')
+    parser.add_argument('csv', nargs='?', default=GRID_PATH)
+    parser.add_argument('out', nargs='?', default='app/grid_store')
+    args = parser.parse_args()
+
+    grid_store = convert_grid_csv(args.csv, args.out)
+    print(f"{len(grid_store)} grid cells written to {args.out} (version {grid_store.version})")
@@ -1,37 +1,112 @@
 #!pip install quantities
-import nltk
-from nltk.stem import WordNetLemmatizer
-from nltk.corpus import stopwords
-
-from quantities import units
-from transformers import pipeline
-
-import pandas as pd
-import urllib3
-import requests
-
-def load_libraries():
-    nltk.download('stopwords', quiet=True)
-    nltk.download('wordnet', quiet=True)
-    nltk.download('omw-1.4', quiet=True)
-    nltk.download('words', quiet=True)
-    nltk.download('punkt', quiet=True)
-    nltk.download('averaged_perceptron_tagger', quiet=True)
-
-    # Create a custom PoolManager with increased timeout
-    # http = urllib3.PoolManager(timeout=30.0)
-    session = requests.Session()
-    session.request = requests.Request()
-    session.request.timeout = 20.0
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
+import app.Metrics as metrics
+
+# nltk (about 2 s, it imports scipy) and quantities are imported when they are first used, so the
+# API starts without them and loads them in the background, see load_libraries.
+
+# NLTK data used by the extraction, looked up offline in the nltk.data.path directories
+NLTK_RESOURCES = {
+    'stopwords': 'corpora/stopwords',
+    'wordnet': 'corpora/wordnet',
+    'omw-1.4': 'corpora/omw-1.4',
+    'words': 'corpora/words',
+    'punkt': 'tokenizers/punkt',
+    'averaged_perceptron_tagger': 'taggers/averaged_perceptron_tagger',
+}
+
+# NLTK 3.9 reads the tokenizer and the tagger from new, pickle-free packages
+NLTK_39_RESOURCES = {
+    'punkt_tab': 'tokenizers/punkt_tab',
+    'averaged_perceptron_tagger_eng': 'taggers/averaged_perceptron_tagger_eng',
+}
+
+# only missing resources are downloaded, GEOHILFE_OFFLINE=1 never downloads (the image has to ship the data)
+OFFLINE = os.environ.get('GEOHILFE_OFFLINE', '0') == '1'
+
+def nltk_resources():
+    import nltk
+
+    resources = dict(NLTK_RESOURCES)
+    if tuple(int(part) for part in nltk.__version__.split('.')[:2]) >= (3, 9):
+        del resources['punkt'], resources['averaged_perceptron_tagger']
+        resources.update(NLTK_39_RESOURCES)
+    return resources
+
+def missing_resources():
+    import nltk
+
+    missing = []
+    for package, resource in nltk_resources().items():
+        try:
+            nltk.data.find(resource)
+        except LookupError:
+            missing.append(package)
+    return missing
+
+def load_libraries(download=not OFFLINE):
+    import nltk
+
+    missing = missing_resources()
+    if len(missing) > 0 and download:
+        for package in missing:
+            nltk.download(package, quiet=True)
+        missing = missing_resources()
+    if len(missing) > 0:
+        raise LookupError(f"NLTK data not found: {', '.join(missing)} (python -m nltk.downloader {' '.join(missing)})")
+
+    from nltk.corpus import stopwords
     sw_nltk = stopwords.words('english')
-    #qa_model = pipeline("question-answering", model='deepset/roberta-base-squad2', session=session)
+    #from transformers import pipeline
+    #qa_model = pipeline("question-answering", model='deepset/roberta-base-squad2')
     qa_model = None
 
+    # the tagger and the lemmatizer are loaded here instead of on the first request
+    get_tagger()
+    get_lemmatizer().lemmatize('warmup')
+
     return sw_nltk, qa_model
 
+### ----- Per-process resources, built once ----- ###
+
+# processes used by extract_keywords_batch, 0 keeps the extraction in the calling process
+EXTRACT_WORKERS = int(os.environ.get('GEOHILFE_EXTRACT_WORKERS', 0))
+
+@lru_cache(maxsize=None)
+def get_tagger():
+    # nltk.pos_tag loads the perceptron model again on every call
+    from nltk.tag import PerceptronTagger
+    return PerceptronTagger()
+
+@lru_cache(maxsize=None)
+def get_chunk_parser():
+    import nltk
+
+    # Extract noun phrases using chunking
+    #NP: {<DT>?<JJ>*<NN.*>+}
+    grammar = r""" 
+      NP: {<JJ>*<NN.*>+}
+    """
+    return nltk.RegexpParser(grammar)
+
+@lru_cache(maxsize=None)
+def get_distance_units():
+    from quantities import units
+    return frozenset(units.length.__dict__.keys())
+
+@lru_cache(maxsize=None)
+def get_lemmatizer():
+    from nltk.stem import WordNetLemmatizer
+    return WordNetLemmatizer()
+
+@lru_cache(maxsize=4096)
 def get_singular_form(word):
-    lemmatizer = WordNetLemmatizer()
+    lemmatizer = get_lemmatizer()
     singular = lemmatizer.lemmatize(word, pos='n')
     return singular
 
@@ -43,18 +118,18 @@ def remove_sw(text, sw_nltk):
 def extract_keywords_from_sentence(sentence, sw_nltk, qa_model=''):
     # Tokenize the sentence into individual words
     #tokens = nltk.word_tokenize(remove_sw(sentence, sw_nltk))
-    tokens = nltk.word_tokenize(sentence)
+    import nltk
+    with metrics.stage('tagging'):
+        tokens = nltk.word_tokenize(sentence)
 
-    # Apply part-of-speech tagging
-    tagged_words = nltk.pos_tag(tokens)
+        # Apply part-of-speech tagging
+        tagged_words = get_tagger().tag(tokens)
 
+    return extract_keywords_from_tagged(tagged_words)
+
+def extract_keywords_from_tagged(tagged_words):
     # Extract noun phrases using chunking
-    #NP: {<DT>?<JJ>*<NN.*>+}
-    grammar = r""" 
-      NP: {<JJ>*<NN.*>+}
-    """
-    chunk_parser = nltk.RegexpParser(grammar)
-    parsed_tree = chunk_parser.parse(tagged_words)
+    parsed_tree = get_chunk_parser().parse(tagged_words)
     # Extract noun phrases from the parsed tree
     noun_phrases = []
     pronouns = ['PRP', 'PRP$', 'WP', 'WP$']
@@ -66,7 +141,7 @@ def extract_keywords_from_sentence(sentence, sw_nltk, qa_model=''):
 
     # Print the extracted noun phrases
     # print(noun_phrases)
-    distance_units = list(units.length.__dict__.keys())
+    distance_units = get_distance_units()
     
     pronouns = ['he', 'she', 'it', 'they', 'we', 'you', 'i', 'me', 'him', 'her', 'us', 'them', 'myself', 'yourself', 'himself', 'herself', 'itself', 'ourselves', 'yourselves', 'themselves']
     possible_locations = [ploc for ploc in noun_phrases if get_singular_form(ploc) not in distance_units]
@@ -76,3 +151,95 @@ def extract_keywords_from_sentence(sentence, sw_nltk, qa_model=''):
     [keywords.append(x) for x in possible_locations if x not in keywords] 
     
     return keywords
+
+### ----- Batch extraction ----- ###
+
+_process_pool = None
+
+def get_process_pool(workers):
+    # the pool is kept for the life of the process, the workers build their resources once. They are
+    # spawned like the shard workers, a fork of the threaded server could inherit held locks.
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+    return _process_pool
+
+def extract_keywords_batch(sentences, workers=EXTRACT_WORKERS, chunk_size=64):
+    """
+    extract_keywords_from_sentence for many utterances, e.g. when re-processing recorded calls.
+    The utterances are tagged in batches and, with workers > 1, split across a process pool.
+    """
+    sentences = list(sentences)
+    if workers > 1 and len(sentences) > chunk_size:
+        chunks = [sentences[i:i + chunk_size] for i in range(0, len(sentences), chunk_size)]
+        results = get_process_pool(workers).map(extract_keywords_batch, chunks)
+        return [keywords for chunk in results for keywords in chunk]
+
+    import nltk
+    with metrics.stage('tagging'):
+        tagged_sentences = get_tagger().tag_sents([nltk.word_tokenize(sentence) for sentence in sentences])
+    return [extract_keywords_from_tagged(tagged_words) for tagged_words in tagged_sentences]
+
+### ----- Streaming transcript extraction ----- ###
+
+# Live transcripts are rarely punctuated. An unended sentence of STREAM_FLUSH_WORDS words, or one that
+# has been waiting for STREAM_FLUSH_SECONDS, is processed up to its last STREAM_UNSTABLE_WORDS words,
+# which are kept for the next fragments (a street or place name may continue there).
+STREAM_FLUSH_WORDS = int(os.environ.get('GEOHILFE_STREAM_FLUSH_WORDS', 12))
+STREAM_FLUSH_SECONDS = float(os.environ.get('GEOHILFE_STREAM_FLUSH_SECONDS', 3))
+STREAM_UNSTABLE_WORDS = int(os.environ.get('GEOHILFE_STREAM_UNSTABLE_WORDS', 3))
+
+class TranscriptExtractor():
+    """
+    Keyword state of one live call. Transcript fragments are buffered until they complete a
+    sentence (or until the unended sentence is long or old enough, see STREAM_FLUSH_WORDS), only
+    the new text is tagged and chunked, and only the keywords that were not found earlier in
+    the call are returned.
+    """
+    sentence_endings = ('.', '!', '?')
+
+    def __init__(self, flush_words=STREAM_FLUSH_WORDS, flush_seconds=STREAM_FLUSH_SECONDS,
+                 unstable_words=STREAM_UNSTABLE_WORDS, clock=time.monotonic):
+        self.flush_words = flush_words
+        self.flush_seconds = flush_seconds
+        self.unstable_words = unstable_words
+        self.clock = clock
+        self.pending = ""
+        self.pending_since = None
+        self.keywords = []
+
+    def add_fragment(self, fragment, final=False):
+        # fragments are whole words or phrases, they are joined with a space
+        self.pending = " ".join(part for part in [self.pending, fragment.strip()] if part)
+        if self.pending == "":
+            return []
+        if self.pending_since is None:
+            self.pending_since = self.clock()
+
+        import nltk
+        sentences = nltk.sent_tokenize(self.pending)
+
+        # the last sentence is kept until it is ended, long or old enough, or the transcript is final
+        if final or self.pending.endswith(self.sentence_endings):
+            self.pending = ""
+        else:
+            self.pending = sentences.pop()
+            words = self.pending.split()
+            if len(words) > self.unstable_words and (len(words) >= self.flush_words or self.clock() - self.pending_since >= self.flush_seconds):
+                sentences.append(" ".join(words[:-self.unstable_words]))
+                self.pending = " ".join(words[-self.unstable_words:])
+                self.pending_since = self.clock()
+        if self.pending == "":
+            self.pending_since = None
+
+        with metrics.stage('tagging'):
+            tagged_sentences = get_tagger().tag_sents([nltk.word_tokenize(sentence) for sentence in sentences])
+
+        new_keywords = []
+        for tagged_words in tagged_sentences:
+            for keyword in extract_keywords_from_tagged(tagged_words):
+                if keyword not in self.keywords:
+                    self.keywords.append(keyword)
+                    new_keywords.append(keyword)
+
+        return new_keywords
@@ -0,0 +1,142 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Process-local metrics in the Prometheus text exposition format, served by /metrics.
+# Each worker process keeps its own values; Prometheus scrapes and aggregates the workers.
+
+# seconds, from sub-millisecond lookups up to slow dataset loads
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CELL_BUCKETS = (1, 10, 50, 100, 300, 1000, 3000, 10000, 30000, 100000, 300000, 1000000)
+
+def format_labels(names, values):
+    if len(names) == 0:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric():
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        # metrics without labels are exported from the start
+        if len(self.labels) == 0:
+            self.values[()] = self.zero()
+
+    def zero(self):
+        return 0
+
+    def key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.extend(self.samples(key, value))
+        return lines
+
+    def samples(self, key, value):
+        return [f"{self.name}{format_labels(self.labels, key)} {format_value(value)}"]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels)
+
+    def zero(self):
+        # per bucket (non-cumulative) counts with the +Inf bucket last, and the sum
+        return [[0] * (len(self.buckets) + 1), 0.0]
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = self.zero()
+            counts, _ = self.values[key]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key][1] += value
+
+    def samples(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = format_labels(self.labels + ("le",), key + (format_value(float(bound)),))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_value(total)}")
+        lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+### ----- Metrics of the service ----- ###
+
+# grid_load, origin_lookup, cone_subset, bbox_serialization, tagging, prefilter, embedding, string_similarity, ranking
+STAGE_SECONDS = Histogram('geohilfe_stage_duration_seconds', 'Duration of the pipeline stages.', ['stage'])
+REQUEST_SECONDS = Histogram('geohilfe_request_duration_seconds', 'Duration of the HTTP requests.', ['endpoint', 'status'])
+REQUESTS_IN_FLIGHT = Gauge('geohilfe_requests_in_flight', 'HTTP requests being processed.', ['endpoint'])
+CELLS_SCORED = Histogram('geohilfe_cells_scored', 'Grid cells scored per /similarity request.', buckets=CELL_BUCKETS)
+CELLS_SCORED_TOTAL = Counter('geohilfe_cells_scored_total', 'Grid cells scored by /similarity requests.')
+ACTIVE_CALLS = Gauge('geohilfe_active_calls', 'Calls with a loaded blue cone session.')
+CONE_CACHE = Counter('geohilfe_cone_cache_requests_total', 'Cone lookups by cache result (hit, miss, precomputed).', ['result'])
+READY = Gauge('geohilfe_ready', 'Whether the models and the grid store are loaded.')
+
+REGISTRY = [STAGE_SECONDS, REQUEST_SECONDS, REQUESTS_IN_FLIGHT, CELLS_SCORED, CELLS_SCORED_TOTAL, CONE_CACHE, ACTIVE_CALLS, READY]
+
+@contextmanager
+def stage(name):
+    # with metrics.stage('cone_subset'): ...
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+
+def count_cells_scored(cells):
+    CELLS_SCORED.observe(cells)
+    CELLS_SCORED_TOTAL.inc(cells)
+
+def render(registry=REGISTRY):
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,202 @@
+import hashlib
+import os
+import tempfile
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import app.SimilarityModel as sm
+import app.VectorStore as vs
+
+# Common keywords ("Kaufland", "Bahnhof", "school") come up call after call. Their components (see
+# SimilarityModel.COMPONENTS) are computed once over all cells of the grid and shared by every call,
+# a request only gathers the rows of its cone. An entry takes 40 bytes per populated cell (5.6 MB
+# for 140,000 populated cells). Bounded in bytes, 0 disables the index.
+SCORE_INDEX_BYTES = int(os.environ.get('GEOHILFE_SCORE_INDEX_BYTES', 256 * 1024 * 1024))
+
+# Scoring a keyword over the whole grid takes much longer than over a cone, so a request that misses
+# the index only scores its rows. Keywords missed SCORE_INDEX_REPEATS times are added to the index by
+# a background thread, off the request path.
+SCORE_INDEX_REPEATS = int(os.environ.get('GEOHILFE_SCORE_INDEX_REPEATS', 2))
+
+# keywords whose misses are counted
+MAX_COUNTED_KEYWORDS = 10000
+
+# optional directory where the computed components are kept across restarts
+SCORE_INDEX_PATH = os.environ.get('GEOHILFE_SCORE_INDEX_PATH')
+
+def normalize_keyword(keyword):
+    # keywords typed or extracted in different ways map to the same entry
+    return " ".join(unicodedata.normalize('NFC', keyword).split())
+
+def vectors_id(nlp):
+    # the components depend on the word vectors and on the name matching, entries are kept per both
+    if isinstance(nlp, vs.MmapVectors):
+        vectors = nlp.pipeline or os.path.basename(os.path.normpath(nlp.path))
+    else:
+        meta = getattr(nlp, 'meta', {})
+        vectors = f"{meta.get('lang')}_{meta.get('name')}-{meta.get('version')}"
+    return f"{vectors}-ngram-index" if sm.NAME_INDEX else vectors
+
+def populated_rows(database):
+    # cells without keywords, streets and landmarks have all-zero components, they are not stored
+    if 'populated_rows' not in database.derived:
+        counts = database.keywords.counts() + database.streets.counts() + database.landmarks.counts()
+        rows = np.flatnonzero(counts > 0)
+        positions = np.full(len(database), -1, dtype=np.int64)
+        positions[rows] = np.arange(len(rows))
+        database.derived['populated_rows'] = (rows, positions)
+    return database.derived['populated_rows']
+
+class ScoreIndex():
+    """
+    LRU index of keyword components over the populated cells of a grid store, keyed by dataset
+    version, word vectors and normalized keyword. Entries are float64 (COMPONENTS, populated cells)
+    arrays, so gathered rows are the same as components computed for the rows directly.
+    """
+    def __init__(self, max_bytes=SCORE_INDEX_BYTES, path=SCORE_INDEX_PATH, repeats=SCORE_INDEX_REPEATS):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.repeats = repeats
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.misses = OrderedDict()
+        self.pending = set()
+        self.filler = ThreadPoolExecutor(max_workers=1, thread_name_prefix='geohilfe-index')
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _filename(self, key):
+        version, vectors, keyword = key
+        digest = hashlib.sha1(keyword.encode('utf-8')).hexdigest()
+        safe = lambda name: "".join(c for c in str(name) if c.isalnum() or c in "-_.")
+        return os.path.join(self.path, safe(version), safe(vectors), f'{digest}.npy')
+
+    def _load(self, key):
+        if self.path is None:
+            return None
+        try:
+            return np.load(self._filename(key))
+        except (FileNotFoundError, ValueError, EOFError):
+            return None
+
+    def _store(self, key, components):
+        if self.path is None:
+            return
+        filename = self._filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, components)
+        os.replace(tmp_filename, filename)
+
+    def _add(self, key, components):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = components
+            self.nbytes += components.nbytes
+            while self.nbytes > self.max_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def fill(self, key, nlp, database):
+        # components of a keyword over all populated cells, added to the index (and stored on disk)
+        try:
+            populated, _ = populated_rows(database)
+            components = np.ascontiguousarray(sm.keyword_components([key[2]], nlp, database, populated)[0])
+            self._add(key, components)
+            self._store(key, components)
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+    def _missed(self, key, nlp, database):
+        # counts a miss, the keyword is filled in the background once it has been missed self.repeats times
+        with self.lock:
+            self.misses[key] = self.misses.pop(key, 0) + 1
+            while len(self.misses) > MAX_COUNTED_KEYWORDS:
+                self.misses.popitem(last=False)
+            if self.misses[key] < self.repeats or key in self.pending or key in self.entries:
+                return
+            del self.misses[key]
+            self.pending.add(key)
+        self.filler.submit(self.fill, key, nlp, database)
+
+    def components(self, keywords, nlp, database, rows):
+        """
+        (keywords, COMPONENTS, rows) array like SimilarityModel.keyword_components, for the
+        normalized keywords. Missing keywords are loaded from disk or computed for the rows.
+        """
+        keywords = [normalize_keyword(keyword) for keyword in keywords]
+        populated, positions = populated_rows(database)
+        keys = {keyword: (database.version, vectors_id(nlp), keyword) for keyword in keywords}
+
+        found = {}
+        with self.lock:
+            for keyword, key in keys.items():
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    found[keyword] = self.entries[key]
+
+        missing = []
+        for keyword in dict.fromkeys(keywords):
+            if keyword in found:
+                continue
+            components = self._load(keys[keyword])
+            if components is not None and components.shape == (len(sm.COMPONENTS), len(populated)):
+                found[keyword] = components
+                self._add(keys[keyword], components)
+            else:
+                missing.append(keyword)
+
+        rows = np.asarray(rows, dtype=np.int64)
+        computed = {}
+        if len(missing) > 0:
+            computed = dict(zip(missing, sm.keyword_components(missing, nlp, database, rows)))
+            for keyword in missing:
+                self._missed(keys[keyword], nlp, database)
+
+        # gather the rows of the indexed keywords, the empty cells stay 0
+        row_positions = positions[rows]
+        stored = row_positions >= 0
+        gathered = np.zeros((len(keywords), len(sm.COMPONENTS), len(rows)))
+        for i, keyword in enumerate(keywords):
+            if keyword in computed:
+                gathered[i] = computed[keyword]
+            else:
+                gathered[i][:, stored] = found[keyword][:, row_positions[stored]]
+        return gathered
+
+    def derive(self, previous, database, rows, nlp):
+        """
+        Entries of a single-cell update (GridStore.with_cells): the in-memory components of previous
+        are copied to database and only the updated rows are scored again. Returns the number of entries.
+        """
+        vectors = vectors_id(nlp)
+        with self.lock:
+            entries = [(key[2], components) for key, components in self.entries.items()
+                       if key[0] == previous.version and key[1] == vectors]
+        if len(entries) == 0:
+            return 0
+
+        old_populated, old_positions = populated_rows(previous)
+        populated, _ = populated_rows(database)
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        # cells that were populated before and are not updated keep their components
+        kept = np.flatnonzero((old_positions[populated] >= 0) & ~np.isin(populated, rows))
+        updated = np.flatnonzero(np.isin(populated, rows))
+
+        keywords = [keyword for keyword, _ in entries]
+        computed = sm.keyword_components(keywords, nlp, database, populated[updated])
+        for (keyword, old_components), new_rows in zip(entries, computed):
+            components = np.zeros((len(sm.COMPONENTS), len(populated)))
+            components[:, kept] = old_components[:, old_positions[populated[kept]]]
+            components[:, updated] = new_rows
+            self._add((database.version, vectors, keyword), components)
+        return len(entries)
@@ -0,0 +1,242 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Call sessions hold the blue cone subset of one emergency call between /bluecone, /similarity and /reset.
+# The default store lives in the worker process, use a file or redis store when running several workers.
+SESSION_STORE = os.environ.get('GEOHILFE_SESSION_STORE', 'memory')
+SESSION_TTL = float(os.environ.get('GEOHILFE_SESSION_TTL', 2 * 60 * 60))
+MAX_SESSIONS = int(os.environ.get('GEOHILFE_MAX_SESSIONS', 1000))
+
+# seconds between two sweeps of expired and surplus sessions of the file store
+EXPIRE_INTERVAL = float(os.environ.get('GEOHILFE_SESSION_EXPIRE_INTERVAL', 60))
+
+# The keyword scores of a call are only kept in the worker process, they are not written to the session
+# store with every /similarity request. A call served by another worker scores its keywords again.
+SCORE_CACHE_BYTES = int(os.environ.get('GEOHILFE_SCORE_CACHE_BYTES', 256 * 1024 * 1024))
+
+def new_call_id():
+    return uuid.uuid4().hex
+
+class MemorySessionStore():
+    """
+    Bounded in-process session store. Sessions expire `ttl` seconds after their last use and
+    the least recently used session is evicted once there are more than `max_sessions`.
+    """
+    def __init__(self, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL, clock=time.monotonic):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.clock = clock
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            self._expire()
+            return len(self.sessions)
+
+    def _expire(self):
+        now = self.clock()
+        while self.sessions:
+            call_id, (last_used, _) = next(iter(self.sessions.items()))
+            if now - last_used <= self.ttl:
+                break
+            del self.sessions[call_id]
+
+    def get(self, call_id):
+        with self.lock:
+            self._expire()
+            if call_id not in self.sessions:
+                return None
+            _, session = self.sessions.pop(call_id)
+            self.sessions[call_id] = (self.clock(), session)
+            return session
+
+    def set(self, call_id, session):
+        with self.lock:
+            self.sessions.pop(call_id, None)
+            self.sessions[call_id] = (self.clock(), session)
+            self._expire()
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def delete(self, call_id):
+        with self.lock:
+            return self.sessions.pop(call_id, None) is not None
+
+class FileSessionStore():
+    """
+    Session store in a local directory shared by all workers on the host, one pickle file per call.
+    The file modification time is the last use, it drives both the TTL and the LRU eviction. Expired
+    and surplus sessions are removed at most every `expire_interval` seconds, reads check the TTL.
+    """
+    def __init__(self, path, max_sessions=MAX_SESSIONS, ttl=SESSION_TTL, expire_interval=EXPIRE_INTERVAL):
+        self.path = path
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.expire_interval = expire_interval
+        self.last_sweep = float('-inf')
+        os.makedirs(path, exist_ok=True)
+
+    def _filename(self, call_id):
+        # call ids are sent by clients, the file name is their hash so that distinct ids never share a file
+        digest = hashlib.sha1(str(call_id).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, f'{digest}.session')
+
+    def _files(self):
+        files = []
+        for name in os.listdir(self.path):
+            if name.endswith('.session'):
+                filename = os.path.join(self.path, name)
+                try:
+                    files.append((os.path.getmtime(filename), filename))
+                except FileNotFoundError:
+                    pass
+        return sorted(files)
+
+    def __len__(self):
+        self._expire()
+        return len(self._files())
+
+    def _expire(self):
+        now = time.time()
+        for mtime, filename in self._files():
+            if now - mtime > self.ttl:
+                self._remove(filename)
+
+    def _touch(self, filename):
+        # explicit timestamps, the file system clock can be too coarse to order quick successive uses
+        now = time.time()
+        os.utime(filename, (now, now))
+
+    def _remove(self, filename):
+        try:
+            os.remove(filename)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def get(self, call_id):
+        filename = self._filename(call_id)
+        try:
+            if time.time() - os.path.getmtime(filename) > self.ttl:
+                self._remove(filename)
+                return None
+            with open(filename, 'rb') as f:
+                session = pickle.load(f)
+            self._touch(filename)
+            return session
+        except (FileNotFoundError, EOFError):
+            return None
+
+    def set(self, call_id, session):
+        # write to a temporary file first so other workers never read a partial session
+        fd, tmp_filename = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(session, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, self._filename(call_id))
+        self._touch(self._filename(call_id))
+
+        # listing the directory stats every session file, it is not done on every write
+        if time.monotonic() - self.last_sweep >= self.expire_interval:
+            self.sweep()
+
+    def sweep(self):
+        self.last_sweep = time.monotonic()
+        self._expire()
+        files = self._files()
+        for _, filename in files[:max(len(files) - self.max_sessions, 0)]:
+            self._remove(filename)
+
+    def delete(self, call_id):
+        return self._remove(self._filename(call_id))
+
+class RedisSessionStore():
+    """
+    Session store on a redis server, shared by all workers and hosts. Expiry is handled by redis,
+    LRU eviction is left to the server's maxmemory-policy.
+    """
+    def __init__(self, url, ttl=SESSION_TTL, prefix='geohilfe:session:'):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(match=f'{self.prefix}*'))
+
+    def get(self, call_id):
+        key = self.prefix + str(call_id)
+        data = self.client.get(key)
+        if data is None:
+            return None
+        self.client.expire(key, int(self.ttl))
+        return pickle.loads(data)
+
+    def set(self, call_id, session):
+        self.client.set(self.prefix + str(call_id), pickle.dumps(session, protocol=pickle.HIGHEST_PROTOCOL), ex=int(self.ttl))
+
+    def delete(self, call_id):
+        return self.client.delete(self.prefix + str(call_id)) > 0
+
+class ScoreCache():
+    """
+    LRU cache of the keyword components of the calls in this worker process, bounded in bytes.
+    An entry belongs to one cone of a call: it is only used with the same dataset version and cone_id.
+    """
+    def __init__(self, max_bytes=SCORE_CACHE_BYTES, max_keywords=256):
+        self.max_bytes = max_bytes
+        self.max_keywords = max_keywords
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, call_id, session):
+        # {keyword: components} of the cone of session, empty for a new cone
+        owner = (session["dataset_version"], session.get("cone_id"))
+        with self.lock:
+            if call_id in self.entries and self.entries[call_id][0] == owner:
+                self.entries.move_to_end(call_id)
+                return dict(self.entries[call_id][1])
+        return {}
+
+    def set(self, call_id, session, scores, keywords=()):
+        # only the keywords of the last request are kept once a call has sent more than max_keywords
+        if len(scores) > self.max_keywords:
+            scores = {keyword: scores[keyword] for keyword in keywords if keyword in scores}
+        nbytes = sum(components.nbytes for components in scores.values())
+        with self.lock:
+            self._pop(call_id)
+            if nbytes > self.max_bytes:
+                return
+            self.entries[call_id] = ((session["dataset_version"], session.get("cone_id")), scores, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                self.nbytes -= self.entries.popitem(last=False)[1][2]
+
+    def _pop(self, call_id):
+        if call_id in self.entries:
+            self.nbytes -= self.entries.pop(call_id)[2]
+
+    def delete(self, call_id):
+        with self.lock:
+            self._pop(call_id)
+
+def create_session_store(url=SESSION_STORE):
+    # "memory", "file:///path/to/dir" or "redis://host:port/db"
+    if url.startswith('file://'):
+        return FileSessionStore(url[len('file://'):])
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return RedisSessionStore(url)
+    if url == 'memory':
+        return MemorySessionStore()
+    raise ValueError(f"unknown session store: {url}")
@@ -1,38 +1,80 @@
 #import geo_database as gb
-from ast import literal_eval
-import spacy
+import os
+import pickle
+import re
 import warnings
 import numpy as np
-import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity as cs
 import subprocess
 import jellyfish
-from nltk.util import ngrams
+
+import app.GridStore as gs
+import app.Metrics as metrics
+import app.VectorStore as vs
 
 warnings.filterwarnings("ignore", category=FutureWarning)
 
-def sm_init():
-    try:
-        nlp = spacy.load('en_core_web_lg')
-    except:
-        print("en_core_web_lg not found, downloading spacy model...")
-        subprocess.call(['python', '-m', "spacy", "download", "en_core_web_lg"])
-        nlp = spacy.load('en_core_web_lg')
+# Opt-in pruning of the street/landmark matching: only the names sharing at least one character bigram
+# with a keyword are scored, the others get a score of 0. Without a shared bigram the n-gram similarity is
+# 0, so their exact score is 0.15 * Jaro-Winkler (0.85 * Jaro-Winkler above 0.85, which needs very short names).
+NAME_INDEX = os.environ.get('GEOHILFE_NAME_INDEX', '0') == '1'
+
+# replicas without network access (GEOHILFE_OFFLINE=1) fail on a missing spaCy model instead of downloading it
+OFFLINE = os.environ.get('GEOHILFE_OFFLINE', '0') == '1'
+
+# Cascade ranking: cones with more than CASCADE_SIZE cells are first ranked by their token overlap with the
+# keywords, only the CASCADE_SIZE best of them are scored in full (0 scores every cell). RERANK_MODEL is an
+# optional pickled model that re-ranks the shortlist, see Reranker.
+CASCADE_SIZE = int(os.environ.get('GEOHILFE_CASCADE_SIZE', 0))
+RERANK_MODEL = os.environ.get('GEOHILFE_RERANK_MODEL', '')
+
+def load_nlp():
+    # the exported vectors (python -m app.VectorStore) are memory-mapped and shared by the workers,
+    # the full spaCy pipeline is only loaded when they are not available
+    if os.path.isdir(vs.VECTORS_PATH):
+        nlp = vs.MmapVectors(vs.VECTORS_PATH)
+    else:
+        # spaCy is only imported when the pipeline has to be loaded
+        import spacy
+        try:
+            nlp = spacy.load('en_core_web_lg')
+        except OSError:
+            if OFFLINE:
+                raise
+            print("en_core_web_lg not found, downloading spacy model...")
+            subprocess.call(['python', '-m', "spacy", "download", "en_core_web_lg"])
+            nlp = spacy.load('en_core_web_lg')
+    return nlp
+
+def prepare_database(database, nlp, previous=None):
+    """
+    Embeds the grid keywords and builds the name dictionary of a grid store. With the previous
+    snapshot of a single-cell update (GridStore.with_cells), only the new names are embedded and
+    added to the name dictionary and the token index.
+    """
+    if previous is not None:
+        inherit_keyword_embeddings(database, previous, nlp)
+    keyword_embeddings(database, nlp)
+    name_dictionary(database, previous)
+    if CASCADE_SIZE or (previous is not None and 'token_index' in previous.derived):
+        token_index(database, previous)
+
+def sm_init(grid_path=gs.GRID_PATH):
+    nlp = load_nlp()
 
     # This line is used for prototyping on Google Maps data, geo_database is also commented-out above
     #sample_database = gb.create_dataset()
 
-    # make sure that there are no nans in the csv
-    filename = 'app/geohilfe_data_aws_v2.csv'
-    sample_database = pd.read_csv(filename, sep='\t', converters={"northeast": literal_eval, "southwest": literal_eval, 
-                                                        "raw_data": literal_eval, "keywords": literal_eval, "addresses": literal_eval,
-                                                        "landmarks": literal_eval, "subregion": literal_eval, "streets": literal_eval,}).iloc[:, 1:]
+    # the grid store is parsed once per process and shared with the API
+    sample_database = gs.get_grid_store(grid_path)
+
+    # embed the grid keywords and build the name dictionary once at startup
+    prepare_database(sample_database, nlp)
 
     return nlp, sample_database
 
 def kw_vectorizer(kd, kir, nlp):
-    kd_v = [nlp(word).vector for word in kd]
-    kir_v = [nlp(word).vector for word in kir]
+    kd_v = phrase_vectors(kd, nlp)
+    kir_v = phrase_vectors(kir, nlp)
     return kd_v, kir_v
 
 def jaccard_similarity(list1, list2):
@@ -50,6 +92,7 @@ def keyword_similarity(keywords_detected, keywords_in_row, nlp):
     kd_v, kir_v = kw_vectorizer(keywords_detected, keywords_in_row, nlp)
     
     # what is returned is a (x, y) matrix --> (x, 300) * (300, y), find the max value of each row
+    from sklearn.metrics.pairwise import cosine_similarity as cs
     res = cs(kd_v, kir_v).max(axis=1)
 
     # eliminate all zeros that were due to OOVs, convert it to NaNs, return the mean
@@ -59,8 +102,82 @@ def keyword_similarity(keywords_detected, keywords_in_row, nlp):
     #res.mean()
     return similarity_score_mean
 
+### ----- Precomputed keyword embeddings ----- ###
+
+def phrase_vectors(texts, nlp):
+    if isinstance(nlp, vs.MmapVectors):
+        return nlp.phrase_vectors(texts)
+
+    # the vectors only depend on the tokens, so the tagger/parser/ner do not need to run
+    make_doc = getattr(nlp, 'make_doc', nlp)
+    vectors = [make_doc(text).vector for text in texts]
+    if len(vectors) == 0:
+        return np.zeros((0, nlp.vocab.vectors_length), dtype=np.float32)
+    return np.array(vectors, dtype=np.float32)
+
+def normalized_vectors(texts, nlp):
+    # rows with a norm of 0 (OOVs) stay 0, the same as in sklearn's cosine_similarity
+    vectors = phrase_vectors(texts, nlp)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+def keyword_embeddings(database, nlp):
+    # normalized vectors of all distinct grid keywords, computed once per grid store
+    cached = database.derived.get('keyword_embeddings')
+    if cached is None or cached[0] is not nlp:
+        cached = (nlp, normalized_vectors(database.keywords.names, nlp))
+        database.derived['keyword_embeddings'] = cached
+    return cached[1]
+
+def inherit_keyword_embeddings(database, previous, nlp):
+    # the keyword names of an updated snapshot start with the names of the previous one
+    cached = previous.derived.get('keyword_embeddings')
+    names = database.keywords.names
+    if cached is None or cached[0] is not nlp or len(cached[1]) == 0 or previous.keywords.names != names[:len(cached[1])]:
+        return
+    embeddings = cached[1]
+    if len(names) > len(embeddings):
+        embeddings = np.vstack([embeddings, normalized_vectors(names[len(embeddings):], nlp)])
+    database.derived['keyword_embeddings'] = (nlp, embeddings)
+
+def keyword_max_similarities(keywords_detected, nlp, database, rows):
+    """
+    keyword_similarity before the mean, for all the given rows at once: one matrix product between
+    the detected keywords and the distinct grid keywords, then the max over the keywords of each cell.
+    Returns a (keywords, rows) matrix, cells without keywords get 0.
+    """
+    table = database.keywords.take(rows)
+    max_similarities = np.zeros((len(keywords_detected), len(rows)))
+    if len(keywords_detected) == 0 or len(table.indices) == 0:
+        return max_similarities
+
+    kd_v = normalized_vectors(keywords_detected, nlp)
+    sims = kd_v @ keyword_embeddings(database, nlp).T
+
+    # max of each detected keyword over the keywords of each (non-empty) cell
+    non_empty = np.flatnonzero(table.counts() > 0)
+    max_similarities[:, non_empty] = np.maximum.reduceat(sims[:, table.indices], table.indptr[non_empty], axis=1)
+
+    return max_similarities
+
+def keyword_scores(max_similarities, database, rows):
+    # eliminate all zeros that were due to OOVs, convert it to NaNs, return the mean
+    res = np.array(max_similarities, dtype=np.float64)
+    res[res == 0] = np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        scores = np.nanmean(res, axis=0) if len(res) else np.zeros(len(rows))
+
+    # if the row has no entries, the similarity score is 0
+    scores[database.keywords.counts()[rows] == 0] = 0
+    return scores
+
 ### ----- Similarity computation for proper nouns ----- ###
 
+def ngrams(text, n):
+    # character n-grams as tuples, like nltk.util.ngrams (which would import all of nltk)
+    return zip(*(text[i:] for i in range(n)))
+
 def compute_ngram_similarity(str1, str2, n=2):
     str1_ngrams = set(ngrams(str1, n))
     str2_ngrams = set(ngrams(str2, n))
@@ -117,53 +234,425 @@ def prop_noun_sim(keywords, streets):
         
         return cwm
 
-### ---------------------------------------------------- ###
+### ----- Batched street/landmark similarity ----- ###
 
-def user_keyword_handler(keywords, nlp, database):
+class NameDictionary():
+    """
+    Distinct street and landmark names of a grid store with their precomputed bigram sets.
+    A keyword is scored once against every name, the cells then only gather the name scores.
+    With the dictionary of the previous snapshot of a single-cell update, only the appended names
+    are added (see extends_names).
+    """
+    def __init__(self, database, n=2, previous=None):
+        self.n = n
+        self.names = list(previous.names) if previous is not None else []
+        lookup = {name: i for i, name in enumerate(self.names)}
 
-    sample_database = database.reset_index().iloc[:, 1:]
-    grid_no = []
-    grid_coors = []
-    similarity_score_list = [] 
-    for grid in range(len(sample_database)):
-        try:
-            keywords_in_row = sample_database.loc[grid]['keywords']
-            streets_info = sample_database.loc[grid]['streets']
-            landmarks_info = sample_database.loc[grid]['landmarks']
+        # position in the dictionary of every name of the streets/landmarks string tables
+        self.table_ids = {}
+        for column in ["streets", "landmarks"]:
+            known = previous.table_ids[column] if previous is not None else np.zeros(0, dtype=np.int64)
+            ids = []
+            for name in getattr(database, column).names[len(known):]:
+                if name not in lookup:
+                    lookup[name] = len(self.names)
+                    self.names.append(name)
+                ids.append(lookup[name])
+            self.table_ids[column] = np.concatenate([known, np.array(ids, dtype=np.int64)])
 
-            if keywords_in_row == []:
-                similarity_score_keywords = 0
-            else:
-                similarity_score_keywords = keyword_similarity(keywords, keywords_in_row, nlp)
+        start = len(previous.names) if previous is not None else 0
+        new_ngrams = [set(ngrams(name, n)) for name in self.names[start:]]
+        self.ngrams = (previous.ngrams if previous is not None else []) + new_ngrams
+        self.ngram_counts = np.concatenate([previous.ngram_counts if previous is not None else np.zeros(0, dtype=np.int64),
+                                            np.array([len(name_ngrams) for name_ngrams in new_ngrams], dtype=np.int64)])
 
-            if streets_info == []:
-                similarity_score_streets = 0
-            else:
-                similarity_score_streets = prop_noun_sim(keywords, streets_info)
+        # inverted indices: n-gram to the names that contain it, and name to the cells of each column
+        postings = {}
+        for i, name_ngrams in enumerate(new_ngrams, start):
+            for ngram in name_ngrams:
+                postings.setdefault(ngram, []).append(i)
+        self.ngram_index = dict(previous.ngram_index) if previous is not None else {}
+        for ngram, ids in postings.items():
+            ids = np.array(ids, dtype=np.int64)
+            self.ngram_index[ngram] = np.concatenate([self.ngram_index[ngram], ids]) if ngram in self.ngram_index else ids
+
+        self.name_cells = {}
+        for column in ["streets", "landmarks"]:
+            table = getattr(database, column)
+            ids = self.table_ids[column][table.indices]
+            cells = np.repeat(np.arange(len(table), dtype=np.int64), table.counts())
+            order = np.argsort(ids, kind='stable')
+            indptr = np.searchsorted(ids[order], np.arange(len(self.names) + 1))
+            self.name_cells[column] = (indptr, cells[order])
+
+    def __len__(self):
+        return len(self.names)
+
+    def candidates(self, keyword):
+        # names sharing at least one n-gram with the keyword
+        keyword_ngrams = [self.ngram_index[ngram] for ngram in set(ngrams(keyword, self.n)) if ngram in self.ngram_index]
+        if len(keyword_ngrams) == 0:
+            return np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(keyword_ngrams))
+
+    def combined_similarities(self, keyword, ids=None, weight_jw=0.65, weight_ng=0.35):
+        # combined_similarity(keyword, name) for every name in the dictionary, or only for the names of ids
+        ids = np.arange(len(self.names)) if ids is None else ids
+        jaro_winkler_sim = np.array([jellyfish.jaro_winkler(keyword, self.names[i]) for i in ids], dtype=np.float64)
+
+        keyword_ngrams = set(ngrams(keyword, self.n))
+        intersection = np.array([len(keyword_ngrams & self.ngrams[i]) for i in ids], dtype=np.float64)
+        # a pair without any n-gram (single characters) gets an n-gram similarity of 0
+        ngram_sim = intersection / np.maximum(np.maximum(self.ngram_counts[ids], len(keyword_ngrams)), 1)
+
+        weight_jw = np.where(ngram_sim <= 0.25, 0.15, weight_jw)
+        weight_ng = np.where(ngram_sim <= 0.25, 0.85, weight_ng)
+        weight_jw = np.where(jaro_winkler_sim >= 0.85, 0.85, weight_jw)
+        weight_ng = np.where(jaro_winkler_sim >= 0.85, 0.15, weight_ng)
+
+        return weight_jw * jaro_winkler_sim + weight_ng * ngram_sim
+
+def extends_names(database, previous, columns):
+    # the string tables of a single-cell update keep the names of the previous snapshot and append new ones
+    return all(getattr(previous, column).names == getattr(database, column).names[:len(getattr(previous, column).names)]
+               for column in columns)
 
-            if landmarks_info == []:
-                similarity_score_landmarks = 0
+def name_dictionary(database, previous=None):
+    if 'name_dictionary' not in database.derived:
+        inherited = None
+        if previous is not None and extends_names(database, previous, ["streets", "landmarks"]):
+            inherited = previous.derived.get('name_dictionary')
+        database.derived['name_dictionary'] = NameDictionary(database, previous=inherited)
+    return database.derived['name_dictionary']
+
+def row_names(database, rows):
+    # dictionary ids of the street and landmark names of the rows, None if that is most of the names
+    dictionary = name_dictionary(database)
+    ids = np.unique(np.concatenate([dictionary.table_ids[column][getattr(database, column).take(rows).indices]
+                                    for column in ["streets", "landmarks"]]))
+    return ids if len(ids) < len(dictionary) // 2 else None
+
+def name_similarities(keywords, database, ids=None):
+    """
+    (keywords, names) matrix of combined similarities, repeated keywords are scored once.
+    With ids, only these names are scored and the other columns are left at 0.
+    """
+    dictionary = name_dictionary(database)
+    scored = {}
+    for keyword in keywords:
+        if keyword not in scored:
+            if ids is None:
+                scored[keyword] = dictionary.combined_similarities(keyword)
             else:
-                similarity_score_landmarks = prop_noun_sim(keywords, landmarks_info)
-
-            # TODO: At some point, if there are too many keywords, then the similarity scores across all categories degrade
-            # make logic that removes the keyword if there is a high match?
-            similarity_score = 0.5*similarity_score_streets + 0.3* similarity_score_landmarks + 0.2*similarity_score_keywords
-            
-            grid_no.append(str(sample_database.loc[grid]['grid_num']))
-            
-            center = ((sample_database.loc[grid]['northeast'][1] + sample_database.loc[grid]['southwest'][1])/2, 
-                      (sample_database.loc[grid]['northeast'][0] + sample_database.loc[grid]['southwest'][0])/2)
-            
-            grid_coors.append(center)
-            similarity_score_list.append(similarity_score)
-            
-        except Exception as e:
-            print(e)
-        
-    grid_no = [x for _, x in sorted(zip(similarity_score_list, grid_no), reverse=True)]
-    grid_coors = [x for _, x in sorted(zip(similarity_score_list, grid_coors), reverse=True)]
-    similarity_score_list = sorted(similarity_score_list, reverse=True)
+                scored[keyword] = np.zeros(len(dictionary))
+                scored[keyword][ids] = dictionary.combined_similarities(keyword, ids)
+    
+    if len(keywords) == 0:
+        return np.zeros((0, len(dictionary)))
+    return np.array([scored[keyword] for keyword in keywords])
+
+def prop_noun_sums(similarities, database, column, rows, sigma=0.35):
+    """
+    prop_noun_sim for all the given rows of the streets or landmarks column, split per keyword.
+
+    The Gaussian weights of calculate_eq_weights are normalized per cell, so the weighted mean of a
+    cell is sum(w * v) / sum(w) over all its (keyword, name) pairs. Returns both sums for every
+    (keyword, row), summed over the names of each cell, see prop_noun_scores.
+    """
+    table = getattr(database, column).take(rows)
+    ids = name_dictionary(database).table_ids[column][table.indices]
+
+    weighted_sum = np.zeros((len(similarities), len(rows)))
+    weights_sum = np.zeros((len(similarities), len(rows)))
+    if len(similarities) == 0 or len(ids) == 0:
+        return weighted_sum, weights_sum
+
+    values = similarities[:, ids]
+    weights = np.exp(-np.abs(1 - values)**2 / (2 * sigma**2))
+
+    non_empty = np.flatnonzero(table.counts() > 0)
+    weighted_sum[:, non_empty] = np.add.reduceat(weights * values, table.indptr[non_empty], axis=1)
+    weights_sum[:, non_empty] = np.add.reduceat(weights, table.indptr[non_empty], axis=1)
+
+    return weighted_sum, weights_sum
+
+def pruned_prop_noun_sums(keywords, database, column, rows, sigma=0.35):
+    """
+    prop_noun_sums with NAME_INDEX: only the candidate names of each keyword are scored and only their
+    cells are visited. The other names of a cell count with a score of 0, i.e. a weight of
+    exp(-1 / (2 * sigma**2)) and no weighted value, which is added for all names of the cell at once.
+    """
+    dictionary = name_dictionary(database)
+    rows = np.asarray(rows, dtype=np.int64)
+    order = np.argsort(rows, kind='stable')
+    sorted_rows = rows[order]
+
+    zero_weight = np.exp(-1 / (2 * sigma**2))
+    counts = getattr(database, column).counts()[rows]
+    weighted_sum = np.zeros((len(keywords), len(rows)))
+    weights_sum = np.tile(zero_weight * counts, (len(keywords), 1)).astype(np.float64)
+    if len(rows) == 0:
+        return weighted_sum, weights_sum
+
+    indptr, name_cells = dictionary.name_cells[column]
+    scored = {}
+    for i, keyword in enumerate(keywords):
+        if keyword not in scored:
+            ids = dictionary.candidates(keyword)
+            scored[keyword] = (ids, dictionary.combined_similarities(keyword, ids))
+        ids, values = scored[keyword]
+
+        # cells of the candidate names, with one entry per occurrence like the string tables
+        lengths = indptr[ids + 1] - indptr[ids]
+        offsets = np.repeat(indptr[ids] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        cells = name_cells[offsets]
+        values = np.repeat(values, lengths)
+
+        # only the entries of the scored rows count
+        positions = np.minimum(np.searchsorted(sorted_rows, cells), len(rows) - 1)
+        found = sorted_rows[positions] == cells
+        targets = order[positions[found]]
+        values = values[found]
+
+        weights = np.exp(-np.abs(1 - values)**2 / (2 * sigma**2))
+        weighted_sum[i] += np.bincount(targets, weights * values, minlength=len(rows))
+        weights_sum[i] += np.bincount(targets, weights - zero_weight, minlength=len(rows))
+
+    return weighted_sum, weights_sum
+
+def prop_noun_scores(weighted_sum, weights_sum):
+    # if streets/landmarks is empty, the score is 0.0
+    weighted_sum = np.sum(weighted_sum, axis=0)
+    weights_sum = np.sum(weights_sum, axis=0)
+    return np.divide(weighted_sum, weights_sum, out=np.zeros(len(weights_sum)), where=weights_sum > 0)
+
+### ----- Per keyword components ----- ###
+
+# Every detected keyword contributes independently to the scores of a cell: its max keyword similarity
+# and its sums of the street and landmark weighted means. The components of a keyword can therefore be
+# computed once per call and combined with the components of the other keywords of a request.
+COMPONENTS = ["keywords", "streets_weighted", "streets_weights", "landmarks_weighted", "landmarks_weights"]
+
+def keyword_components(keywords, nlp, database, rows):
+    # (keywords, COMPONENTS, rows) array
+    with metrics.stage('embedding'):
+        max_similarities = keyword_max_similarities(keywords, nlp, database, rows)
+
+    # street and landmark scores come from the keywords scored once against the name dictionary
+    with metrics.stage('string_similarity'):
+        if NAME_INDEX:
+            streets_weighted, streets_weights = pruned_prop_noun_sums(keywords, database, "streets", rows)
+            landmarks_weighted, landmarks_weights = pruned_prop_noun_sums(keywords, database, "landmarks", rows)
+        else:
+            # small subsets (cones, cascade shortlists) only score the names of their cells
+            similarities = name_similarities(keywords, database, row_names(database, rows))
+            streets_weighted, streets_weights = prop_noun_sums(similarities, database, "streets", rows)
+            landmarks_weighted, landmarks_weights = prop_noun_sums(similarities, database, "landmarks", rows)
+
+    return np.stack([max_similarities, streets_weighted, streets_weights, landmarks_weighted, landmarks_weights], axis=1)
+
+def component_scores(components, database, rows):
+    # keyword, street and landmark scores of the rows
+    return (keyword_scores(components[:, 0], database, rows),
+            prop_noun_scores(components[:, 1], components[:, 2]),
+            prop_noun_scores(components[:, 3], components[:, 4]))
+
+def combine_components(components, database, rows):
+    similarity_scores_keywords, similarity_scores_streets, similarity_scores_landmarks = component_scores(components, database, rows)
+
+    # TODO: At some point, if there are too many keywords, then the similarity scores across all categories degrade
+    # make logic that removes the keyword if there is a high match?
+    return 0.5*similarity_scores_streets + 0.3*similarity_scores_landmarks + 0.2*similarity_scores_keywords
+
+### ---------------------------------------------------- ###
+
+def rank_cells(similarity_scores, grid_no, top_k=None, min_score=None):
+    """
+    Positions of the best cells in decreasing order of similarity score. Ties are ordered by
+    decreasing grid number string and NaN scores come last, like sorting the (score, grid_no) pairs.
+    Only the top_k cells are sorted, the rest is dropped with argpartition.
+    """
+    scores = np.where(np.isnan(similarity_scores), -np.inf, similarity_scores)
+    candidates = np.arange(len(scores))
+    if min_score is not None:
+        candidates = candidates[scores >= min_score]
+
+    if top_k is not None and top_k < len(candidates):
+        if top_k <= 0:
+            return candidates[:0]
+        # keep every cell tied with the k-th score so the ties are ordered the same way as a full sort
+        kth = -np.partition(-scores[candidates], top_k - 1)[top_k - 1]
+        candidates = candidates[scores[candidates] >= kth]
+
+    order = np.lexsort((grid_no[candidates], scores[candidates]))[::-1]
+    return candidates[order][:top_k]
+
+### ----- Cascade ranking ----- ###
+
+# Word tokens of the names, compound street names are split at their capitals (MeersburgerStraße).
+TOKEN_PATTERN = re.compile(r'[^\W\d_]+|\d+')
+CAMEL_CASE = re.compile(r'(?<=[a-zäöüß])(?=[A-ZÄÖÜ])')
+
+# weights of the columns in the prefilter score, like the weights of combine_components
+PREFILTER_WEIGHTS = {"keywords": 0.2, "streets": 0.5, "landmarks": 0.3}
+
+def name_tokens(name):
+    return [token.casefold() for token in TOKEN_PATTERN.findall(CAMEL_CASE.sub(' ', name))]
+
+class TokenIndex():
+    """
+    Word tokens of the keyword, street and landmark names of a grid store, for the cheap first stage
+    of the cascade. A cell scores the inverse document frequencies of the keyword tokens its names share,
+    so common tokens (straße, weg) count less than rare ones. With the index of the previous snapshot
+    of a single-cell update, only the appended names are tokenized.
+    """
+    def __init__(self, database, previous=None):
+        self.vocabulary = dict(previous.vocabulary) if previous is not None else {}
+        self.name_tokens = {}
+        for column in PREFILTER_WEIGHTS:
+            known_indptr, known_tokens = previous.name_tokens[column] if previous is not None else (np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64))
+            tokens, indptr = [], []
+            for name in getattr(database, column).names[len(known_indptr) - 1:]:
+                for token in dict.fromkeys(name_tokens(name)):
+                    if token not in self.vocabulary:
+                        self.vocabulary[token] = len(self.vocabulary)
+                    tokens.append(self.vocabulary[token])
+                indptr.append(len(known_tokens) + len(tokens))
+            self.name_tokens[column] = (np.concatenate([known_indptr, np.array(indptr, dtype=np.int64)]),
+                                        np.concatenate([known_tokens, np.array(tokens, dtype=np.int64)]))
+
+        # document frequency of a token: the cells with a name that contains it (once per name)
+        frequencies = np.zeros(len(self.vocabulary))
+        for column in PREFILTER_WEIGHTS:
+            table = getattr(database, column)
+            indptr, tokens = self.name_tokens[column]
+            name_cells = np.bincount(table.indices, minlength=len(table.names))
+            frequencies += np.bincount(tokens, weights=np.repeat(name_cells, np.diff(indptr)), minlength=len(self.vocabulary))
+
+        self.idf = np.log1p(len(database) / (1 + frequencies))
+
+    def scores(self, keywords, database, rows):
+        # prefilter score of the rows, 0 for cells without a shared token
+        ids = [self.vocabulary[token] for keyword in keywords for token in name_tokens(keyword) if token in self.vocabulary]
+        hits = np.zeros(len(self.idf))
+        hits[ids] = self.idf[ids]
+
+        scores = np.zeros(len(rows))
+        for column, weight in PREFILTER_WEIGHTS.items():
+            indptr, tokens = self.name_tokens[column]
+            name_scores = np.diff(np.concatenate([[0], np.cumsum(hits[tokens])])[indptr])
+            table = getattr(database, column).take(rows)
+            scores += weight * np.diff(np.concatenate([[0], np.cumsum(name_scores[table.indices])])[table.indptr])
+        return scores
+
+def token_index(database, previous=None):
+    if 'token_index' not in database.derived:
+        inherited = None
+        if previous is not None and extends_names(database, previous, PREFILTER_WEIGHTS):
+            inherited = previous.derived.get('token_index')
+        database.derived['token_index'] = TokenIndex(database, previous=inherited)
+    return database.derived['token_index']
+
+def shortlist_cells(prefilter_scores, size):
+    """
+    Positions (in the given rows, sorted) of the at most size cells with the best prefilter scores.
+    Cells without a token hit are not shortlisted; None if no cell has a hit, the cheap stage
+    has nothing to go on then and all the cells are scored.
+    """
+    hits = np.flatnonzero(prefilter_scores > 0)
+    if len(hits) == 0:
+        return None
+    if len(hits) > size:
+        hits = np.sort(hits[np.argpartition(-prefilter_scores[hits], size - 1)[:size]])
+    return hits
+
+class Reranker():
+    """
+    Optional second opinion on the shortlist: a pickled model with a scikit-learn interface that gets one
+    row of features per cell, the keyword, street and landmark scores and the prefilter score (FEATURES).
+    predict_proba()[:, 1] (or predict()) replaces the similarity score. The model has to be trained on these
+    features; the bundled models/RF_Model_V1.pkl is not such a model.
+    """
+    FEATURES = ["keywords", "streets", "landmarks", "prefilter"]
+
+    def __init__(self, model):
+        self.model = model
+
+    @classmethod
+    def load(cls, path=RERANK_MODEL):
+        with open(path, 'rb') as f:
+            return cls(pickle.load(f))
+
+    def __call__(self, features):
+        # one batched prediction for all the shortlisted cells
+        if hasattr(self.model, 'predict_proba'):
+            return np.asarray(self.model.predict_proba(features))[:, 1].astype(np.float64)
+        return np.asarray(self.model.predict(features), dtype=np.float64)
+
+_rerankers = {}
+
+def get_reranker(path=RERANK_MODEL):
+    # None without a configured model, loaded once per process
+    if not path:
+        return None
+    if path not in _rerankers:
+        _rerankers[path] = Reranker.load(path)
+    return _rerankers[path]
+
+### ---------------------------------------------------- ###
+
+def score_cells(keywords, nlp, database, rows=None, top_k=None, min_score=None, cache=None, index=None, cascade=None, reranker=None):
+    """
+    Positions of the ranked cells in the grid store and their scores. database is the GridStore,
+    rows are the positions of the cells to be scored (all cells if None). With a ScoreIndex, the
+    components of new keywords are gathered from the index instead of computed for the rows.
+    With cascade, more than cascade rows are shortlisted by shortlist_cells first and only the
+    shortlisted cells are scored and returned. A Reranker replaces the scores of the scored cells.
+    """
+    if rows is None:
+        rows = np.arange(len(database))
+    rows = np.asarray(rows, dtype=np.int64)
+
+    prefilter_scores = None
+    if (cascade and len(rows) > cascade) or reranker is not None:
+        with metrics.stage('prefilter'):
+            prefilter_scores = token_index(database).scores(keywords, database, rows)
+            shortlist = shortlist_cells(prefilter_scores, cascade) if cascade and len(rows) > cascade else None
+        if shortlist is not None:
+            rows, prefilter_scores = rows[shortlist], prefilter_scores[shortlist]
+            # the cached components of a call belong to all of its rows
+            cache = None
+
+    # cache maps keywords to their components for these rows (one call), only new keywords are scored
+    if cache is None:
+        cache = {}
+    new_keywords = [keyword for keyword in dict.fromkeys(keywords) if keyword not in cache]
+    if len(new_keywords) > 0:
+        if index is None:
+            components = keyword_components(new_keywords, nlp, database, rows)
+        else:
+            components = index.components(new_keywords, nlp, database, rows)
+        cache.update(zip(new_keywords, components))
+
+    with metrics.stage('ranking'):
+        components = np.array([cache[keyword] for keyword in keywords]).reshape(len(keywords), len(COMPONENTS), len(rows))
+        similarity_scores = combine_components(components, database, rows)
+        if reranker is not None:
+            # cells without keyword scores (NaN) get a keyword feature of 0
+            features = np.column_stack(component_scores(components, database, rows) + (prefilter_scores,))
+            similarity_scores = reranker(np.nan_to_num(features))
+
+        # only the best cells are sorted and returned
+        grid_no = database.grid_num[rows].astype(str)
+        ranked = rank_cells(similarity_scores, grid_no, top_k, min_score)
+
+    return rows[ranked], similarity_scores[ranked]
+
+def user_keyword_handler(keywords, nlp, database, rows=None, top_k=None, min_score=None, cache=None, cascade=None, reranker=None):
+    positions, similarity_scores = score_cells(keywords, nlp, database, rows, top_k, min_score, cache, cascade=cascade, reranker=reranker)
+    
+    # the center is sent as (lon, lat)
+    centers = database.center[positions]
+    grid_coors = list(zip(centers[:, 1].tolist(), centers[:, 0].tolist()))
     
-    return grid_no, grid_coors, similarity_score_list
-    
\ No newline at end of file
+    return database.grid_num[positions].astype(str).tolist(), grid_coors, similarity_scores.tolist()
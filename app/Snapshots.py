@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+import app.GridStore as gs
+
+# Versioned grid dataset snapshots of the running service. A new snapshot is loaded and indexed off the
+# request path and then swapped in; new calls use it, calls in progress keep the snapshot of their blue
+# cone. The last SNAPSHOTS_KEPT snapshots are kept, older calls are asked to send their cone again.
+SNAPSHOTS_KEPT = int(os.environ.get('GEOHILFE_SNAPSHOTS_KEPT', 3))
+
+# seconds between two checks of the dataset file for a new snapshot, 0 turns the watcher off
+RELOAD_INTERVAL = float(os.environ.get('GEOHILFE_RELOAD_INTERVAL', 0))
+
+class SnapshotRegistry():
+    """
+    Grid stores by dataset version with the path they were loaded from (None for snapshots made
+    by single-cell updates). current is the snapshot of new calls.
+    """
+    def __init__(self, kept=SNAPSHOTS_KEPT):
+        self.kept = kept
+        self.stores = OrderedDict()
+        self.sources = {}
+        self.current = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.stores)
+
+    def publish(self, grid_store, source=None):
+        # the store has to be fully indexed, it is used by requests right after the swap
+        with self.lock:
+            self.stores[grid_store.version] = grid_store
+            self.stores.move_to_end(grid_store.version)
+            self.sources[grid_store.version] = source
+            self.current = grid_store
+            while len(self.stores) > max(self.kept, 1):
+                version, _ = self.stores.popitem(last=False)
+                del self.sources[version]
+
+    def get(self, version):
+        with self.lock:
+            return self.stores.get(version)
+
+    def source(self, version):
+        with self.lock:
+            return self.sources.get(version)
+
+    def versions(self):
+        with self.lock:
+            return list(self.stores)
+
+def source_signature(path):
+    # changes when the dataset file (or the meta.json of a converted store) is replaced
+    if os.path.isdir(path):
+        path = os.path.join(path, 'meta.json')
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def source_version(path):
+    # dataset version of a file without parsing it
+    if os.path.isdir(path):
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            return json.load(f)['version']
+    return gs.file_version(path)
+
+def cell_updates(grid_store, cells):
+    """
+    {row: update} of a list of {"grid_number": ..., "keywords": [...], "streets": [...], "landmarks": [...]}
+    and the version of the updated snapshot, derived from the current version and the updates.
+    """
+    rows = {}
+    if not isinstance(cells, list) or not all(isinstance(cell, dict) for cell in cells):
+        raise ValueError("cells has to be a list of objects")
+    for cell in cells:
+        # grid numbers are sent as strings by the default /similarity answer
+        grid_number = cell.get('grid_number')
+        if isinstance(grid_number, str) and grid_number.isdigit():
+            grid_number = int(grid_number)
+        if not isinstance(grid_number, int) or isinstance(grid_number, bool):
+            raise ValueError("grid_number has to be an integer")
+        positions = np.flatnonzero(np.asarray(grid_store.grid_num) == grid_number)
+        if len(positions) == 0:
+            raise KeyError(f"grid number {grid_number}")
+        # a string would be split into its characters, only lists of strings are taken
+        for column in gs.STRING_TABLES:
+            if column in cell and (not isinstance(cell[column], list) or not all(isinstance(entry, str) for entry in cell[column])):
+                raise ValueError(f"{column} of grid number {grid_number} has to be a list of strings")
+        update = {column: list(cell[column]) for column in gs.STRING_TABLES if column in cell}
+        rows.setdefault(int(positions[0]), {}).update(update)
+
+    content = json.dumps([grid_store.version, sorted(rows.items())], ensure_ascii=False, sort_keys=True)
+    return rows, hashlib.sha1(content.encode('utf-8')).hexdigest()[:12]
+
+class FileWatcher(threading.Thread):
+    # calls on_change(path) from this thread when the dataset file is replaced
+    def __init__(self, path, on_change, interval=RELOAD_INTERVAL):
+        super().__init__(name='geohilfe-watcher', daemon=True)
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self.signature = source_signature(path)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            signature = source_signature(self.path)
+            if signature is None or signature == self.signature:
+                continue
+            self.signature = signature
+            try:
+                self.on_change(self.path)
+            except Exception as e:
+                # a broken file keeps the current snapshot, the next replacement is picked up again
+                print(f"reloading {self.path} failed: {type(e).__name__}: {e}")
+
+    def stop(self):
+        self.stopped.set()
@@ -0,0 +1,77 @@
+import numpy as np
+
+class GridHashIndex():
+    """
+    Regular-grid hash over the cell bounding boxes, built once per grid store.
+
+    The covered area is split into buckets about the size of one grid cell and every cell is
+    registered in the buckets its bounding box overlaps. Queries only look at the cells of the
+    buckets they touch and then do the exact (inclusive) bounding box test on those.
+    """
+    def __init__(self, northeast, southwest, bucket_size=None):
+        self.northeast = northeast
+        self.southwest = southwest
+
+        if bucket_size is None:
+            # one bucket per cell for a regular grid
+            bucket_size = (float(np.median(northeast[:, 0] - southwest[:, 0])),
+                           float(np.median(northeast[:, 1] - southwest[:, 1])))
+        self.bucket_size = np.array([max(size, 1e-9) for size in bucket_size])
+        self.origin = southwest.min(axis=0) if len(southwest) else np.zeros(2)
+        extent = (northeast.max(axis=0) - self.origin) if len(northeast) else np.zeros(2)
+        self.shape = np.floor(extent / self.bucket_size).astype(np.int64) + 1
+
+        # bucket ranges of every cell, one entry per (cell, bucket) pair
+        start = self.bucket_of(southwest)
+        stop = self.bucket_of(northeast)
+        lat_span = stop[:, 0] - start[:, 0] + 1
+        lon_span = stop[:, 1] - start[:, 1] + 1
+        counts = lat_span * lon_span
+
+        cells = np.repeat(np.arange(len(northeast), dtype=np.int64), counts)
+        offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        lat_bucket = np.repeat(start[:, 0], counts) + offset // np.repeat(lon_span, counts)
+        lon_bucket = np.repeat(start[:, 1], counts) + offset % np.repeat(lon_span, counts)
+        keys = lat_bucket * self.shape[1] + lon_bucket
+
+        # CSR from bucket to cells, cells are sorted within every bucket
+        order = np.lexsort((cells, keys))
+        self.cells = cells[order]
+        self.bucket_ptr = np.searchsorted(keys[order], np.arange(self.shape[0] * self.shape[1] + 1))
+
+    def __len__(self):
+        return len(self.northeast)
+
+    def bucket_of(self, points):
+        points = np.asarray(points, dtype=np.float64)
+        buckets = np.floor((points - self.origin) / self.bucket_size).astype(np.int64)
+        return np.clip(buckets, 0, self.shape - 1)
+
+    def query_bbox(self, min_lat, min_lon, max_lat, max_lon):
+        # sorted indices of the cells whose bounding box overlaps the given one
+        if len(self) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        (lat0, lon0), (lat1, lon1) = self.bucket_of([[min_lat, min_lon], [max_lat, max_lon]])
+        rows = np.arange(lat0, lat1 + 1) * self.shape[1]
+        starts = self.bucket_ptr[rows + lon0]
+        stops = self.bucket_ptr[rows + lon1 + 1]
+
+        candidates = np.unique(np.concatenate([self.cells[i:j] for i, j in zip(starts, stops)]))
+        overlap = ((self.southwest[candidates, 0] <= max_lat) & (self.northeast[candidates, 0] >= min_lat)
+                   & (self.southwest[candidates, 1] <= max_lon) & (self.northeast[candidates, 1] >= min_lon))
+        return candidates[overlap]
+
+    def query_radius(self, center, radius_lat, radius_lon):
+        # radius in degrees, see BlueConeCheck.get_cone_constants
+        return self.query_bbox(center[0] - radius_lat, center[1] - radius_lon, center[0] + radius_lat, center[1] + radius_lon)
+
+    def query_point(self, point):
+        return self.query_bbox(point[0], point[1], point[0], point[1])
+
+    def find_cell(self, point):
+        # same result as the linear scan: the first cell that contains the point, None if there is none
+        cells = self.query_point(point)
+        if len(cells) == 0:
+            return None
+        return int(cells[0])
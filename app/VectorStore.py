@@ -0,0 +1,119 @@
+import json
+import os
+import re
+from functools import lru_cache
+
+import numpy as np
+
+# Word vectors exported from the spaCy pipeline. The similarity model only needs `.vector` lookups, so the
+# workers memory-map this table instead of loading the full en_core_web_lg pipeline into every process.
+VECTORS_PATH = os.environ.get('GEOHILFE_VECTORS_PATH', 'app/vectors')
+
+def export_vectors(nlp, path):
+    # writes the vector table of nlp and its key to row index, see write_vectors
+    vectors = nlp.vocab.vectors
+    words = []
+    rows = []
+    for key, row in vectors.key2row.items():
+        if key in nlp.vocab.strings:
+            words.append(nlp.vocab.strings[key])
+            rows.append(row)
+
+    pipeline = f"{nlp.meta.get('lang')}_{nlp.meta.get('name')}-{nlp.meta.get('version')}"
+    write_vectors(words, rows, np.asarray(vectors.data, dtype=np.float32), path, pipeline)
+
+def write_vectors(words, rows, vectors, path, pipeline=None):
+    """
+    Flat files read by MmapVectors: vectors.npy (rows, dim) float32, the sorted words as one
+    UTF-8 blob with offsets, and the vector row of every word.
+    """
+    words = [word.encode('utf-8') for word in words]
+    order = sorted(range(len(words)), key=words.__getitem__)
+    words = [words[i] for i in order]
+    offsets = np.zeros(len(words) + 1, dtype=np.int64)
+    np.cumsum([len(word) for word in words], out=offsets[1:])
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'vectors.npy'), np.ascontiguousarray(vectors, dtype=np.float32))
+    np.save(os.path.join(path, 'words.npy'), np.frombuffer(b''.join(words), dtype=np.uint8))
+    np.save(os.path.join(path, 'offsets.npy'), offsets)
+    np.save(os.path.join(path, 'rows.npy'), np.array([rows[i] for i in order], dtype=np.int64))
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({"pipeline": pipeline, "words": len(words), "dim": int(vectors.shape[1])}, f)
+
+def load_tokenizer():
+    # the rule-based English tokenizer of spaCy is the same one en_core_web_lg uses and does not need the model
+    try:
+        import spacy
+        tokenizer = spacy.blank('en').tokenizer
+        return lambda text: [token.text for token in tokenizer(text)]
+    except ImportError:
+        return re.compile(r"\w+(?:[-.']\w+)*|[^\w\s]").findall
+
+class MmapVectors():
+    """
+    Read-only word vectors memory-mapped from a directory written by export_vectors, so all workers
+    share one copy of the pages. Phrase vectors are the mean of the token vectors with 0 for unknown
+    tokens, the same as spaCy's Doc.vector.
+    """
+    def __init__(self, path=VECTORS_PATH, tokenizer=None):
+        self.path = path
+        self.vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self.words = np.load(os.path.join(path, 'words.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.rows = np.load(os.path.join(path, 'rows.npy'), mmap_mode='r')
+        self.vectors_length = self.vectors.shape[1]
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.pipeline = json.load(f).get('pipeline')
+        self.tokenize = tokenizer or load_tokenizer()
+        self.row_of = lru_cache(maxsize=65536)(self._row_of)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _word(self, i):
+        return self.words[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+    def _row_of(self, word):
+        # binary search in the sorted words, -1 for unknown words
+        key = word.encode('utf-8')
+        low, high = 0, len(self.rows)
+        while low < high:
+            middle = (low + high) // 2
+            if self._word(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.rows) and self._word(low) == key:
+            return int(self.rows[low])
+        return -1
+
+    def word_vector(self, word):
+        row = self.row_of(word)
+        if row < 0:
+            return np.zeros(self.vectors_length, dtype=np.float32)
+        return np.asarray(self.vectors[row], dtype=np.float32)
+
+    def phrase_vector(self, text):
+        tokens = self.tokenize(text)
+        if len(tokens) == 0:
+            return np.zeros(self.vectors_length, dtype=np.float32)
+        return sum(self.word_vector(token) for token in tokens) / len(tokens)
+
+    def phrase_vectors(self, texts):
+        vectors = np.zeros((len(texts), self.vectors_length), dtype=np.float32)
+        for i, text in enumerate(texts):
+            vectors[i] = self.phrase_vector(text)
+        return vectors
+
+if __name__ == '__main__':
+    import argparse
+    import spacy
+
+    parser = argparse.ArgumentParser(description='Export the word vectors of a spaCy pipeline for memory-mapped loading.')
+    parser.add_argument('model', nargs='?', default='en_core_web_lg')
+    parser.add_argument('out', nargs='?', default=VECTORS_PATH)
+    args = parser.parse_args()
+
+    export_vectors(spacy.load(args.model), args.out)
+    print(f"{args.model} vectors written to {args.out}")
@@ -0,0 +1,87 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+# CPU-bound stages (cone subsets, tagging, scoring) run in an executor so they do not block the event loop.
+# "thread" keeps everything in the worker process, "process" moves the stateless stages (keyword
+# extraction) to a process pool, the stages that need the grid store and the embeddings stay on threads.
+EXECUTOR = os.environ.get('GEOHILFE_EXECUTOR', 'thread')
+WORKERS = int(os.environ.get('GEOHILFE_EXECUTOR_WORKERS', os.cpu_count() or 4))
+
+# requests waiting for a free slot of an endpoint, above that the service answers 503
+QUEUE_SIZE = int(os.environ.get('GEOHILFE_QUEUE_SIZE', 32))
+RETRY_AFTER = int(os.environ.get('GEOHILFE_RETRY_AFTER', 1))
+
+def endpoint_concurrency(endpoint):
+    # e.g. GEOHILFE_CONCURRENCY_SIMILARITY=2
+    return int(os.environ.get(f'GEOHILFE_CONCURRENCY_{endpoint.upper()}', WORKERS))
+
+class ServiceSaturated(Exception):
+    def __init__(self, endpoint, retry_after=RETRY_AFTER):
+        super().__init__(f"{endpoint} is saturated, retry after {retry_after}s")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+class EndpointLimiter():
+    """
+    At most `concurrency` requests of an endpoint run at the same time and at most `queue_size`
+    wait for a slot. Requests beyond that are rejected right away instead of piling up.
+    """
+    def __init__(self, endpoint, concurrency, queue_size=QUEUE_SIZE):
+        self.endpoint = endpoint
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.running = 0
+        self.waiting = 0
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def acquire(self, reject=True):
+        if reject and self.semaphore.locked() and self.waiting >= self.queue_size:
+            raise ServiceSaturated(self.endpoint)
+
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.running += 1
+
+    def release(self):
+        self.running -= 1
+        self.semaphore.release()
+
+class WorkerPool():
+    def __init__(self, executor=EXECUTOR, workers=WORKERS, queue_size=QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.limiters = {}
+        self.threads = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='geohilfe')
+        # spawned, not forked: a fork of the threaded server would copy locks held by other threads
+        self.processes = (ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+                          if executor == 'process' else None)
+
+    def limiter(self, endpoint):
+        if endpoint not in self.limiters:
+            self.limiters[endpoint] = EndpointLimiter(endpoint, endpoint_concurrency(endpoint), self.queue_size)
+        return self.limiters[endpoint]
+
+    async def run(self, endpoint, fn, *args, process_safe=False, reject=True):
+        """
+        Runs fn(*args) in the executor within the limits of the endpoint. process_safe functions only
+        depend on their (picklable) arguments and can run in the process pool. With reject=False the
+        request waits for a slot instead of raising ServiceSaturated (used by streaming connections).
+        """
+        limiter = self.limiter(endpoint)
+        await limiter.acquire(reject)
+        try:
+            executor = self.processes if (process_safe and self.processes is not None) else self.threads
+            return await asyncio.get_running_loop().run_in_executor(executor, partial(fn, *args))
+        finally:
+            limiter.release()
+
+    def shutdown(self):
+        self.threads.shutdown(wait=False)
+        if self.processes is not None:
+            self.processes.shutdown(wait=False)
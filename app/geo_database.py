@@ -5,9 +5,16 @@ import pprint
 import re
 import pandas as pd
 
-from gensim.models import KeyedVectors
+import csv
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
 
-# Load the pre-trained Word2Vec model
+# Load the pre-trained Word2Vec model (needs gensim)
+#from gensim.models import KeyedVectors
 #model = KeyedVectors.load_word2vec_format('GoogleNews-vectors-negative300.bin', binary=True)
 
 # Set your Google Maps API key
@@ -104,7 +111,8 @@ def create_dataset():
     initial_coors = (47.663495, 9.173372)
     bearing = 90
     distance_m = 256
-    sample_database = pd.DataFrame(columns=['latitude', 'longitude', 'landmarks', 'street', 'known_addresses', 'keywords'])
+    columns = ['latitude', 'longitude', 'landmarks', 'street', 'known_addresses', 'keywords']
+    rows = []
 
     coors = initial_coors
     x_slices = 3
@@ -125,10 +133,212 @@ def create_dataset():
                          'known_addresses': [ad], 
                          'keywords': [pk]}
 
-            df = pd.DataFrame.from_dict(info_dict)
-            sample_database = sample_database.append(df, ignore_index=True)
+            # the rows are collected first, growing the DataFrame in the loop is quadratic
+            rows.append({column: value[0] if isinstance(value, list) else value for column, value in info_dict.items()})
 
             next_coors = calculate_next(coors, distance_m, bearing)
             coors = next_coors
         coors = calculate_next(anchor_coor, distance_m, 180)
-    return sample_database
\ No newline at end of file
+    sample_database = pd.DataFrame(rows, columns=columns)
+    return sample_database
+
+### ----- Grid dataset builder ----- ###
+
+# Builds the grid file loaded by the API (the geohilfe_data_aws_v2.csv schema) from a places service.
+# The cells are fetched concurrently over one pooled HTTP session within a request rate, every finished
+# cell is appended to a checkpoint file so an interrupted build resumes where it stopped, e.g.
+#   python -m app.geo_database out.csv --url http://localhost:8765/places --columns 15 --rows 20
+#
+# The places service answers GET <url>?bbox=<west>,<south>,<east>,<north> with {"places": [...]},
+# one place per category in the shape of the raw_data entries of the v2 dataset (AWS Location places
+# with an added "Category"). benchmarks/places_stub.py serves synthetic places in that format.
+PLACES_URL = os.environ.get('GEOHILFE_PLACES_URL', 'http://localhost:8765/places')
+PLACES_API_KEY = os.environ.get('GEOHILFE_PLACES_API_KEY')
+
+GRID_ORIGIN = (47.710647, 9.256198)
+GRID_COLUMNS = ["grid_num", "northeast", "southwest", "raw_data", "keywords", "addresses", "landmarks", "subregion", "streets"]
+
+def grid_layout(origin=GRID_ORIGIN, columns=15, rows=20, cell_m=300):
+    """
+    (grid_num, northeast, southwest) of the cells, in rows from north to south and eastwards within
+    a row, the same tiling as the v2 dataset. origin is the northeast corner of the first cell.
+    """
+    grid_num = 1
+    row_northeast = origin
+    row_southwest = calculate_next(calculate_next(origin, cell_m, 270), cell_m, 180)
+    for _ in range(rows):
+        # both corners are walked eastwards along the row and southwards from row to row
+        northeast, southwest = row_northeast, row_southwest
+        for _ in range(columns):
+            yield grid_num, northeast, southwest
+            grid_num += 1
+            northeast = calculate_next(northeast, cell_m, 90)
+            southwest = calculate_next(southwest, cell_m, 90)
+        row_northeast = calculate_next(row_northeast, cell_m, 180)
+        row_southwest = calculate_next(row_southwest, cell_m, 180)
+
+def unique(values):
+    return list(dict.fromkeys(values))
+
+def grid_row(grid_num, northeast, southwest, places):
+    # one grid cell of the v2 dataset, the lists are built from the raw places without duplicates
+    addresses = []
+    landmarks = []
+    for place in places:
+        # Label: "<name>, <street and number>, <postal code>, <municipality>, <region>, <country>"
+        name, _, address = place.get('Label', '').partition(', ')
+        landmarks.append(name)
+        addresses.append(address)
+
+    return {
+        "grid_num": grid_num,
+        "northeast": tuple(northeast),
+        "southwest": tuple(southwest),
+        "raw_data": places,
+        "keywords": unique(place['Category'] for place in places if place.get('Category')),
+        "addresses": unique(address for address in addresses if address),
+        "landmarks": unique(landmark for landmark in landmarks if landmark),
+        "subregion": unique(place['SubRegion'] for place in places if place.get('SubRegion')),
+        "streets": unique(place['Street'].replace(' ', '') for place in places if place.get('Street')),
+    }
+
+class RateLimiter():
+    # at most `rate` acquisitions per second across all threads, 0 or None for no limit
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.interval == 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(self.next_time, now) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+class PlacesClient():
+    """
+    Pooled, rate limited HTTP client of the places service. Connection errors, timeouts, 429 and
+    5xx answers are retried with exponential backoff (or the Retry-After of the answer).
+    """
+    retry_status = {429, 500, 502, 503, 504}
+
+    def __init__(self, url=PLACES_URL, api_key=PLACES_API_KEY, rate=20, retries=5, backoff=0.5, timeout=20, pool_size=32):
+        self.url = url
+        self.rate_limiter = RateLimiter(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if api_key:
+            self.session.headers['Authorization'] = f'Bearer {api_key}'
+
+    def fetch(self, northeast, southwest):
+        params = {"bbox": f"{southwest[1]},{southwest[0]},{northeast[1]},{northeast[0]}"}
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.acquire()
+            retry_after = None
+            try:
+                response = self.session.get(self.url, params=params, timeout=self.timeout)
+                if response.status_code not in self.retry_status:
+                    response.raise_for_status()
+                    return response.json()['places']
+                retry_after = response.headers.get('Retry-After')
+                error = requests.HTTPError(f"{response.status_code} from {self.url}", response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if attempt == self.retries:
+                raise error
+            time.sleep(float(retry_after) if retry_after and retry_after.isdigit() else self.backoff * 2 ** attempt)
+
+    def close(self):
+        self.session.close()
+
+def read_checkpoint(checkpoint):
+    # grid rows of the finished cells, a partly written last line of an interrupted build is ignored
+    rows = {}
+    if not os.path.exists(checkpoint):
+        return rows
+    with open(checkpoint, encoding='utf-8') as f:
+        for line in f:
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            rows[row['grid_num']] = row
+    return rows
+
+def write_grid_file(filename, rows):
+    # tab separated with python literals in the list columns, the format read by GridStore.read_grid_csv
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow([''] + GRID_COLUMNS)
+        for i, row in enumerate(rows):
+            row = dict(row, northeast=tuple(row['northeast']), southwest=tuple(row['southwest']))
+            writer.writerow([i] + [row[column] if column == "grid_num" else repr(row[column]) for column in GRID_COLUMNS])
+    os.replace(tmp_filename, filename)
+
+def build_dataset(filename, client, origin=GRID_ORIGIN, columns=15, rows=20, cell_m=300, workers=16, checkpoint=None):
+    """
+    Fetches the places of every grid cell and writes the grid file. Finished cells are streamed to
+    the checkpoint (filename + '.checkpoint' by default) and skipped when the build is resumed.
+    """
+    checkpoint = checkpoint or filename + '.checkpoint'
+    done = read_checkpoint(checkpoint)
+    pending = ((grid_num, ne, sw) for grid_num, ne, sw in grid_layout(origin, columns, rows, cell_m) if grid_num not in done)
+
+    def fetch_cell(grid_num, northeast, southwest):
+        return grid_row(grid_num, northeast, southwest, client.fetch(northeast, southwest))
+
+    # only a few requests per worker are queued, the layout is generated as the build goes
+    with open(checkpoint, 'a', encoding='utf-8') as f, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = set()
+        for cell in pending:
+            futures.add(executor.submit(fetch_cell, *cell))
+            if len(futures) >= 4 * workers:
+                finished, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    row = future.result()
+                    f.write(json.dumps(row, ensure_ascii=False) + '\n')
+                    done[row['grid_num']] = row
+                f.flush()
+        for future in futures:
+            row = future.result()
+            f.write(json.dumps(row, ensure_ascii=False) + '\n')
+            done[row['grid_num']] = row
+
+    write_grid_file(filename, (done[grid_num] for grid_num in sorted(done)))
+    os.remove(checkpoint)
+    return len(done)
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Build the grid dataset from a places service.')
+    parser.add_argument('out', nargs='?', default='app/geohilfe_data.csv')
+    parser.add_argument('--url', default=PLACES_URL)
+    parser.add_argument('--origin', type=float, nargs=2, default=GRID_ORIGIN, help='northeast corner of the first cell (lat lon)')
+    parser.add_argument('--columns', type=int, default=15)
+    parser.add_argument('--rows', type=int, default=20)
+    parser.add_argument('--cell-size', type=float, default=300, help='cell size in meters')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--rate', type=float, default=20, help='requests per second, 0 for no limit')
+    parser.add_argument('--retries', type=int, default=5)
+    args = parser.parse_args()
+
+    client = PlacesClient(args.url, rate=args.rate, retries=args.retries, pool_size=args.workers)
+    start = time.perf_counter()
+    try:
+        cells = build_dataset(args.out, client, tuple(args.origin), args.columns, args.rows, args.cell_size, args.workers)
+    finally:
+        client.close()
+    print(f"{cells} grid cells written to {args.out} in {time.perf_counter() - start:.1f}s")
@@ -1,18 +1,32 @@
 #from pycaret.classification import load_model, predict_model
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
 import uvicorn
 #from flask import Flask, request
 
-from ast import literal_eval
+import hmac
 import json
-import pandas as pd
+import math
+import os
+import threading
+import numpy as np
+import time
 
 print('loading dependencies...')
 import app.KeyWordExtraction as kwe
 import app.SimilarityModel as sm
 import app.BlueConeCheck as bcc
+import app.CellSets as cs
+import app.ConeCache as cc
+import app.Encoding as enc
+import app.GridStore as gs
+import app.ScoreIndex as si
+import app.SessionStore as ss
+import app.Snapshots as snap
+import app.ShardedScoring as shs
+import app.WorkerPool as wp
+import app.Metrics as metrics
 
 # Create the app, added CORS but this is unsecure since it allows all origins
 app = FastAPI()
@@ -33,7 +47,35 @@ app.add_middleware(
 sw_nltk = None
 qa_model = None
 nlp = None
-sample_database = None
+
+# versioned grid stores: new calls use snapshots.current, calls in progress keep the version of their cone
+snapshots = snap.SnapshotRegistry()
+reload_lock = threading.Lock()
+watcher = None
+
+# /admin endpoints are only served with a token (sent in the X-Admin-Token header)
+ADMIN_TOKEN = os.environ.get('GEOHILFE_ADMIN_TOKEN', '')
+
+# blue cone subsets of the active calls, keyed by call_id
+sessions = ss.create_session_store()
+
+# component scores of the keywords of the calls, kept for their next /similarity requests in this process
+score_cache = ss.ScoreCache()
+
+# components of the keywords over the whole grid, shared by all calls
+score_index = si.ScoreIndex() if si.SCORE_INDEX_BYTES > 0 else None
+
+# covered cells and serialized answers of recent cones and of the precomputed tower sectors
+cone_cache = cc.ConeCache()
+
+# optional re-ranking model of the cascade (GEOHILFE_RERANK_MODEL)
+reranker = None
+
+# wide cones are scored in shards by a process pool (GEOHILFE_SHARD_WORKERS > 0), started with the server
+sharded_scorer = None
+
+# CPU-bound stages run in this pool, with per-endpoint concurrency limits and a bounded queue
+worker_pool = wp.WorkerPool()
 
 cone_origin = None
 cone_radius_m = None
@@ -43,73 +85,335 @@ grid_cells_subset = None
 
 server_status = "loading"
 
+# The models and the grid store are loaded in the background so a new replica answers /health right away.
+# /bluecone and /grid are served as soon as the grid store is loaded, /extract and /similarity when
+# their models are; until then they answer 503 with Retry-After. GEOHILFE_BACKGROUND_WARMUP=0 loads
+# everything before the server accepts requests.
+BACKGROUND_WARMUP = os.environ.get('GEOHILFE_BACKGROUND_WARMUP', '1') == '1'
+loaded = {"grid": False, "extract": False, "similarity": False}
+load_errors = {}
+ENDPOINT_PARTS = {"/grid": "grid", "/bluecone": "grid", "/bluecone/multi": "grid", "/extract": "extract",
+                  "/extract/batch": "extract", "/extract/stream": "extract", "/similarity": "similarity",
+                  "/admin/reload": "grid", "/admin/cells": "grid"}
+
 # TODO: try and make a cleaner version using a class that can be passed
 """class KWDeps():
     def __init__(self, name):
         self.name = name
         self.sw_nltk = None"""
 
-# Loading needed dependencies
-@app.on_event("startup")
-async def startup_event():
-    global nlp
-    global server_status
-    # This code will run when the FastAPI server starts.
-    # You can put your setup code here.
+def prepare_snapshot(grid_cells, previous=None):
+    # the indexes of a snapshot are built before it is published, not on the first requests
+    grid_cells.spatial_index()
+    if nlp is not None:
+        sm.prepare_database(grid_cells, nlp, previous)
+    if previous is None and os.path.exists(cc.CONE_TABLE_PATH):
+        print(f"{cone_cache.load_table(grid_cells)} precomputed tower sectors loaded")
+
+def reload_dataset(path=gs.GRID_PATH):
+    # loads a new snapshot of the dataset file and swaps it in, an unchanged file is not loaded again
+    with reload_lock:
+        current = snapshots.current
+        if current is not None and snap.source_version(path) == current.version and snapshots.source(current.version) == path:
+            return current
+        grid_cells = gs.load_grid_store(path)
+        prepare_snapshot(grid_cells)
+        snapshots.publish(grid_cells, path)
+    print(f"dataset version {grid_cells.version} loaded from {path}")
+    return grid_cells
+
+def update_cells(cells):
+    """
+    Snapshot with the keywords, streets or landmarks of some cells replaced. The tables of the
+    changed columns are copied, the geometry, the spatial index, the cached cones and the score
+    index entries are carried over and only the updated cells are scored again.
+    """
+    with reload_lock:
+        current = snapshots.current
+        rows, version = snap.cell_updates(current, cells)
+        grid_cells = current.with_cells(rows, version)
+        prepare_snapshot(grid_cells, current)
+        if score_index is not None and nlp is not None:
+            score_index.derive(current, grid_cells, list(rows), nlp)
+        cone_cache.carry_over(current.version, version)
+        snapshots.publish(grid_cells)
+    return current, grid_cells
+
+def load_grid():
+    global watcher
+
+    reload_dataset(gs.GRID_PATH)
+    # a replaced dataset file is picked up by every worker process
+    if snap.RELOAD_INTERVAL > 0:
+        watcher = snap.FileWatcher(gs.GRID_PATH, reload_dataset)
+        watcher.start()
+
+def load_extract():
+    global sw_nltk
+    global qa_model
 
     sw_nltk, qa_model = kwe.load_libraries()
-    nlp, _ = sm.sm_init()
-    server_status = "ok"
-    print("Server has started")
 
+def load_similarity():
+    global nlp
+    global reranker
+    global sharded_scorer
+
+    # the snapshot of load_grid is indexed for the loaded vectors
+    loaded_nlp = sm.load_nlp()
+    with reload_lock:
+        sm.prepare_database(snapshots.current, loaded_nlp)
+        nlp = loaded_nlp
+    reranker = sm.get_reranker()
+    if shs.SHARD_WORKERS > 0:
+        sharded_scorer = shs.ShardedScorer()
+
+def warm_up():
+    global server_status
+
+    # a part that fails to load is reported by /ready, the other parts are still served
+    for part, load in [("grid", load_grid), ("extract", load_extract), ("similarity", load_similarity)]:
+        if part == "similarity" and not loaded["grid"]:
+            load_errors[part] = "grid store not loaded"
+            continue
+        start = time.perf_counter()
+        try:
+            load()
+        except Exception as e:
+            load_errors[part] = f"{type(e).__name__}: {e}"
+            print(f"loading {part} failed: {load_errors[part]}")
+            continue
+        loaded[part] = True
+        print(f"{part} loaded in {time.perf_counter() - start:.1f}s")
+
+    server_status = "ok" if all(loaded.values()) else "error"
+    print("Server has started" if server_status == "ok" else "Server has started with errors")
+
+def unavailable(part):
+    # 503 for the endpoints whose part is not loaded (yet)
+    if part in load_errors:
+        return JSONResponse(content={"message": f"{part} failed to load: {load_errors[part]}"}, status_code=503)
+    return JSONResponse(content={"message": f"{part} is loading"}, status_code=503, headers={"Retry-After": str(wp.RETRY_AFTER)})
+
+# JSON booleans are ints in Python, they are not accepted as counts or scores
+def is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def cone_error(cone):
+    # message for a cone of /bluecone/multi that cannot be computed, None for a valid cone
+    if not isinstance(cone, dict):
+        return "every cone has to be an object"
+    origin = cone.get('cone_origin')
+    if not isinstance(origin, list) or len(origin) != 2 or not all(is_number(value) for value in origin):
+        return "cone_origin has to be [lat, lon]"
+    for field in ['cone_radius', 'cone_angle', 'cone_direction']:
+        if not is_number(cone.get(field)):
+            return f"{field} has to be a number"
+    if cone.get('cone_inner_radius') is not None and not is_number(cone['cone_inner_radius']):
+        return "cone_inner_radius has to be a number"
+    return None
 
-# Health check to verify if app is running 
+# Loading needed dependencies
+@app.on_event("startup")
+async def startup_event():
+    # This code will run when the FastAPI server starts.
+    if BACKGROUND_WARMUP:
+        threading.Thread(target=warm_up, name='geohilfe-warmup', daemon=True).start()
+    else:
+        warm_up()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    worker_pool.shutdown()
+    if watcher is not None:
+        watcher.stop()
+    if sharded_scorer is not None:
+        sharded_scorer.shutdown()
+
+# A saturated endpoint answers right away so clients can back off instead of waiting in a growing queue
+@app.exception_handler(wp.ServiceSaturated)
+async def saturated_handler(request: Request, exc: wp.ServiceSaturated):
+    return JSONResponse(content={"message": str(exc)}, status_code=503, headers={"Retry-After": str(exc.retry_after)})
+
+# Endpoints answer 503 until the part they need is loaded
+@app.middleware("http")
+async def require_loaded(request: Request, call_next):
+    part = ENDPOINT_PARTS.get(request.url.path)
+    if part is not None and not loaded[part]:
+        return unavailable(part)
+    return await call_next(request)
+
+# Request latency and in-flight requests per endpoint, added last so it also records the 503 answers above
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    # unknown paths share one label so scans do not create new series
+    endpoint = request.url.path
+    if endpoint not in {route.path for route in app.routes}:
+        endpoint = "other"
+    metrics.REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        metrics.REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, status=status)
+
+# Health check to verify if app is running, it does not wait for the models
 @app.get("/health")
 def health_check():
-    global server_status
-
     return {"status": "ok"}
 
+# Readiness check, 503 until the models and the grid store are loaded
+@app.get("/ready")
+def readiness_check():
+    content = {"status": server_status, "loaded": loaded}
+    if load_errors:
+        content["errors"] = load_errors
+    if server_status != "ok":
+        return JSONResponse(content=content, status_code=503)
+    return content
+
+# Prometheus metrics of this worker process
+@app.get("/metrics")
+def get_metrics():
+    metrics.READY.set(1 if server_status == "ok" else 0)
+    metrics.ACTIVE_CALLS.set(len(sessions))
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# Geometry of all grid cells, fetched once per dataset version and cached by the client (compact answers only
+# send grid numbers). ?format=geojson answers a GeoJSON FeatureCollection instead of parallel arrays.
+@app.get("/grid")
+async def get_grid(request: Request, format: str = "compact"):
+    if format not in ["compact", "geojson"]:
+        return JSONResponse(content={"message": f"unknown format: {format}"}, status_code=400)
+
+    grid_cells = snapshots.current
+    etag = f'"{grid_cells.version}-{format}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    body = await worker_pool.run('grid', enc.grid_geometry_body, grid_cells, format == "geojson")
+    return Response(content=body, media_type="application/geo+json" if format == "geojson" else "application/json", headers=headers)
+
 # Blue Signal Cone processing
 # Once a call is accepted, the "answer call" button should send the blue cone info
 @app.post("/bluecone")
 async def process_bluecone(request: Request):
-    global sample_database
     query_data = await request.json()
 
-    # a new blue cone usually means a new subset is needed, reset the grid_cells subset
-    grid_cells_subset = None
+    # every call gets its own session, a call_id can be sent to replace the cone of an ongoing call
+    call_id = query_data.get('call_id') or ss.new_call_id()
+    if query_data.get('format', 'default') not in ["default", "compact"]:
+        return JSONResponse(content={"message": f"unknown format: {query_data['format']}"}, status_code=400)
+
+    response = await worker_pool.run('bluecone', compute_bluecone, call_id, query_data)
+
+    return Response(content=response, media_type="application/json")
 
+def compute_bluecone(call_id, query_data):
     cone_origin = query_data['cone_origin']
     cone_radius_m = query_data['cone_radius']
     cone_angle = query_data['cone_angle']
     cone_direction = query_data['cone_direction']
 
-    filename = 'app/geohilfe_data_aws_v2.csv'
-    grid_cells = pd.read_csv(filename, sep='\t', converters={"northeast": literal_eval, "southwest": literal_eval, 
-                                                        "raw_data": literal_eval, "keywords": literal_eval, "addresses": literal_eval,
-                                                        "landmarks": literal_eval, "subregion": literal_eval, "streets": literal_eval,}).iloc[:, 1:]
-    
-    # cone_origin is a list, send it as a tuple
-    cone_grid = bcc.find_bc_cell(grid_cells, tuple(cone_origin))
-
-    # find the subset of grid_cells to be used
-    grid_cells_idx = bcc.get_grids_subset(grid_cells, tuple(cone_origin), cone_radius_m, cone_angle, cone_direction)
-    grid_cells_subset = grid_cells.loc[grid_cells_idx]
-    sample_database = grid_cells_subset
-
-    p1 = cone_origin
-    p2, p3 = bcc.get_cone_segments(cone_origin, cone_radius_m, cone_angle, cone_direction)
-
-    p1 = [float(i) for i in p1]
-    p2 = [float(i) for i in p2]
-    p3 = [float(i) for i in p3]
-
-    response = {}
-    response["bluecone_points"] = [p1, p2, p3]
-    response["grids"] = bcc.get_bbox_subset(grid_cells_subset)
+    # new calls use the current snapshot of the dataset, the call keeps it until its next blue cone
+    grid_cells = snapshots.current
+
+    # known cones are answered from the cache, the subset and the serialized grids are only computed for new ones
+    cone = cone_cache.get(grid_cells, cone_origin, cone_radius_m, cone_angle, cone_direction)
+    # cone_id tells the score caches of the workers that the cells of the call changed
+    sessions.set(call_id, {"rows": cone["rows"], "dataset_version": grid_cells.version, "cone_id": ss.new_call_id()})
+    score_cache.delete(call_id)
+
+    # compact answers only have the grid numbers, the geometry comes from /grid
+    if query_data.get('format') == "compact":
+        return enc.json_dumps({
+            "call_id": call_id,
+            "dataset_version": grid_cells.version,
+            "bluecone_points": cone["bluecone_points"],
+            "grid_numbers": np.asarray(grid_cells.grid_num[cone["rows"]]),
+        })
+
+    # the cached answer is {"bluecone_points": [p1, p2, p3], "grids": [...]}, the call_id is added in front
+    return b'{"call_id":' + json.dumps(call_id).encode('utf-8') + b',' + cone["body"][1:]
+
+# Several cones of one call (towers, sectors, timing advance rings) combined into one subset
+@app.post("/bluecone/multi")
+async def process_multi_bluecone(request: Request):
+    query_data = await request.json()
 
-    return JSONResponse(content=response)
+    call_id = query_data.get('call_id') or ss.new_call_id()
+    mode = query_data.get('mode', 'intersection')
+    if mode not in cs.MODES:
+        return JSONResponse(content={"message": f"unknown mode: {mode}"}, status_code=400)
+    cones = query_data.get('cones')
+    if not isinstance(cones, list) or len(cones) == 0:
+        return JSONResponse(content={"message": "no cones"}, status_code=400)
+    for cone in cones:
+        message = cone_error(cone)
+        if message is not None:
+            return JSONResponse(content={"message": message}, status_code=400)
+    if not is_count(query_data.get('min_overlap', 1)):
+        return JSONResponse(content={"message": "min_overlap has to be an integer of at least 0"}, status_code=400)
+
+    response = await worker_pool.run('bluecone', compute_multi_bluecone, call_id, query_data)
+
+    return Response(content=enc.json_dumps(response), media_type="application/json")
+
+def cone_rows(grid_cells, cone):
+    # only the covered cells are needed, the /bluecone answer of the cone is not serialized
+    rows = cone_cache.rows(grid_cells, cone['cone_origin'], cone['cone_radius'], cone['cone_angle'], cone['cone_direction'])
+
+    # a timing advance ring is the cone without the cells that lie entirely within the inner radius
+    if cone.get('cone_inner_radius'):
+        inside = bcc.cells_within_radius(grid_cells.northeast[rows], grid_cells.southwest[rows],
+                                         cone['cone_origin'], cone['cone_inner_radius'])
+        rows = rows[~inside]
+    return rows
+
+def compute_multi_bluecone(call_id, query_data):
+    grid_cells = snapshots.current
+    cones = query_data['cones']
+    mode = query_data.get('mode', 'intersection')
+
+    row_sets = [cone_rows(grid_cells, cone) for cone in cones]
+    response = {"call_id": call_id, "mode": mode}
+    if mode == "intersection":
+        rows = cs.intersection(row_sets)
+    elif mode == "union":
+        rows = cs.union(row_sets)
+    else:
+        # counts: the cells covered by at least min_overlap cones and by how many
+        rows, counts = cs.overlap_counts(row_sets)
+        keep = counts >= query_data.get('min_overlap', 1)
+        rows = rows[keep]
+        response["overlap_counts"] = counts[keep]
+
+    # the combined subset is scored by /similarity like the subset of a single cone
+    rows = rows.tolist()
+    sessions.set(call_id, {"rows": rows, "dataset_version": grid_cells.version, "cone_id": ss.new_call_id()})
+    score_cache.delete(call_id)
+
+    response["bluecone_points"] = []
+    for cone in cones:
+        p2, p3 = bcc.get_cone_segments(cone['cone_origin'], cone['cone_radius'], cone['cone_angle'], cone['cone_direction'])
+        response["bluecone_points"].append([[float(i) for i in point] for point in [cone['cone_origin'], p2, p3]])
+
+    if query_data.get('format') == "compact":
+        response["dataset_version"] = grid_cells.version
+        response["grid_numbers"] = np.asarray(grid_cells.grid_num[rows])
+    else:
+        with metrics.stage('bbox_serialization'):
+            response["grids"] = bcc.get_bbox_subset(grid_cells, rows)
+    return response
 
 # Define keyword extraction method
 @app.post('/extract')
@@ -118,7 +422,7 @@ async def get_query(request: Request):
     text = query_data['text']
     print(text)
 
-    prediction = kwe.extract_keywords_from_sentence(text, sw_nltk, qa_model)
+    prediction = await worker_pool.run('extract', kwe.extract_keywords_from_sentence, text, sw_nltk, qa_model, process_safe=True)
 
     # TODO: before returning, check for duplicate keywords?
     response = {
@@ -127,20 +431,154 @@ async def get_query(request: Request):
 
     return JSONResponse(content=response)
 
+# Batch keyword extraction, e.g. to re-process recorded calls
+@app.post('/extract/batch')
+async def get_batch_query(request: Request):
+    query_data = await request.json()
+    texts = query_data['texts']
+
+    # the batch extraction manages its own process pool, it only takes a thread here
+    prediction = await worker_pool.run('extract_batch', kwe.extract_keywords_batch, texts)
+
+    response = {
+        'keywords': prediction
+    }
+
+    return JSONResponse(content=response)
+
+# Streaming keyword extraction for live calls
+# The client sends {"text": <transcript fragment>, "final": <bool>} messages as the transcript grows,
+# the server pushes {"keywords": [...]} with the keywords that were not found earlier in the call
+@app.websocket('/extract/stream')
+async def stream_keywords(websocket: WebSocket):
+    if not loaded["extract"]:
+        # 1013: try again later
+        await websocket.close(code=1013)
+        return
+    await websocket.accept()
+    extractor = kwe.TranscriptExtractor()
+
+    try:
+        while True:
+            query_data = await websocket.receive_json()
+            final = query_data.get('final', False)
+            # the extractor keeps the call's state, so the fragment waits for a slot instead of being rejected
+            new_keywords = await worker_pool.run('extract', extractor.add_fragment, query_data.get('text', ''), final, reject=False)
+
+            if new_keywords or final:
+                await websocket.send_json({'keywords': new_keywords, 'final': final})
+    except WebSocketDisconnect:
+        pass
+
+# Dataset snapshots: reload the dataset file or update single cells while the service is running
+def admin_denied(request):
+    if not ADMIN_TOKEN:
+        return JSONResponse(content={"message": "admin endpoints are disabled, set GEOHILFE_ADMIN_TOKEN"}, status_code=403)
+    if not hmac.compare_digest(request.headers.get('x-admin-token', ''), ADMIN_TOKEN):
+        return JSONResponse(content={"message": "invalid admin token"}, status_code=401)
+    return None
+
+@app.get('/admin/snapshots')
+async def get_snapshots(request: Request):
+    denied = admin_denied(request)
+    if denied is not None:
+        return denied
+    current = snapshots.current
+    return {"current": current.version if current is not None else None, "versions": snapshots.versions()}
+
+@app.post('/admin/reload')
+async def reload_snapshot(request: Request):
+    denied = admin_denied(request)
+    if denied is not None:
+        return denied
+    body = await request.body()
+    path = json.loads(body).get('path', gs.GRID_PATH) if body else gs.GRID_PATH
+    if not os.path.exists(path):
+        return JSONResponse(content={"message": f"dataset not found: {path}"}, status_code=400)
+
+    previous = snapshots.current.version
+    grid_cells = await worker_pool.run('admin', reload_dataset, path)
+    return {"dataset_version": grid_cells.version, "previous_version": previous}
+
+@app.post('/admin/cells')
+async def update_snapshot_cells(request: Request):
+    denied = admin_denied(request)
+    if denied is not None:
+        return denied
+    query_data = await request.json()
+    try:
+        previous, grid_cells = await worker_pool.run('admin', update_cells, query_data['cells'])
+    except KeyError as e:
+        return JSONResponse(content={"message": f"missing or unknown: {e.args[0]}"}, status_code=400)
+    except ValueError as e:
+        return JSONResponse(content={"message": str(e)}, status_code=400)
+    return {"dataset_version": grid_cells.version, "previous_version": previous.version}
+
 # Define the Similarity Function
 @app.post('/similarity')
 async def check_keywords(request: Request):
-    global sample_database
+    query_data = await request.json()
 
-    # This logic prevents similarity from running without the blue cone data
-    if sample_database is None:
+    # This logic prevents similarity from running without the blue cone data of the call
+    session = sessions.get(query_data.get('call_id'))
+    if session is None:
         return JSONResponse(content={"message": "bluecone info not loaded"}, status_code=400)
+    # the call is scored on the snapshot its cone was computed on
+    grid_cells = snapshots.get(session["dataset_version"])
+    if grid_cells is None:
+        return JSONResponse(content={"message": "dataset version of the call is no longer loaded, send the bluecone info again"}, status_code=409)
     
-    query_data = await request.json()
     keywords = query_data['keywords']
-
-    # TODO: change how to connect or pass the database, currently we are using a .csv file
-    grid_no, grid_coors, sim_scores = sm.user_keyword_handler(keywords, nlp, sample_database)
+    response_format = query_data.get('format', 'default')
+    if response_format not in enc.RESPONSE_FORMATS:
+        return JSONResponse(content={"message": f"unknown format: {response_format}"}, status_code=400)
+
+    # optional limits on the returned cells: the top_k best ones with a score of at least min_score
+    top_k = query_data.get('top_k')
+    min_score = query_data.get('min_score')
+    # cones with more cells than cascade are shortlisted by token overlap before the full scoring
+    cascade = query_data.get('cascade', sm.CASCADE_SIZE)
+    for field, value in [('top_k', top_k), ('cascade', cascade)]:
+        if value is not None and not is_count(value):
+            return JSONResponse(content={"message": f"{field} has to be an integer of at least 0"}, status_code=400)
+    if min_score is not None and not is_number(min_score):
+        return JSONResponse(content={"message": "min_score has to be a number"}, status_code=400)
+
+    # the session holds the positions of the blue cone cells in the grid store, the score cache the scores
+    # of the keywords already sent during the call; only the newly added keywords are looked up in the score index
+    cache = score_cache.get(query_data['call_id'], session)
+    sharded = (sharded_scorer is not None and sharded_scorer.use_shards(session["rows"]) and not cascade and reranker is None
+               and snapshots.source(grid_cells.version) == sharded_scorer.grid_path)
+    if sharded:
+        # wide cones are split over the shard workers (which load the snapshots of the dataset file),
+        # their scores are not kept in the score cache
+        try:
+            positions, scores = await worker_pool.run('similarity', sharded_scorer.score_cells, keywords, grid_cells,
+                                                      session["rows"], top_k, min_score)
+        except shs.VersionUnavailable:
+            # a call pinned to a snapshot the workers no longer have (the file was replaced again)
+            sharded = False
+    if not sharded:
+        positions, scores = await worker_pool.run('similarity', sm.score_cells, keywords, nlp, grid_cells,
+                                                  session["rows"], top_k, min_score, cache, score_index, cascade, reranker)
+    metrics.count_cells_scored(len(session["rows"]))
+    if not sharded:
+        score_cache.set(query_data['call_id'], session, cache, keywords)
+
+    # compact answers are parallel arrays of grid numbers and scores (null or NaN for cells without a score)
+    grid_numbers = np.asarray(grid_cells.grid_num[positions])
+    headers = {"X-Dataset-Version": str(grid_cells.version)}
+    if response_format == "binary":
+        return Response(content=enc.encode_scores(grid_numbers, scores), media_type="application/octet-stream", headers=headers)
+    if response_format == "compact":
+        content = {"dataset_version": grid_cells.version, "grid_numbers": grid_numbers, "scores": enc.finite_or_none(scores.tolist())}
+        return Response(content=enc.json_dumps(content), media_type="application/json", headers=headers)
+
+    # the center is sent as (lon, lat)
+    grid_no = grid_numbers.astype(str).tolist()
+    centers = grid_cells.center[positions]
+    grid_coors = list(zip(centers[:, 1].tolist(), centers[:, 0].tolist()))
+    sim_scores = scores.tolist()
 
     response = []
     for entry in range(len(grid_no)):
@@ -154,10 +592,11 @@ async def check_keywords(request: Request):
     return JSONResponse(content=response)
 
 # Define a reset for the AI model
-# Once a call is ended, the reset function should be called so it can handle new blue cone data from another call
+# Once a call is ended, the reset function should be called with its call_id so the blue cone data of the call is unloaded
 @app.post("/reset")
-async def reset_database():
-    global sample_database
-    sample_database = None
+async def reset_database(request: Request):
+    query_data = await request.json() if await request.body() else {}
+    sessions.delete(query_data.get('call_id'))
+    score_cache.delete(query_data.get('call_id'))
 
     return {"status": "call ended, blue cone info unloaded - database reset"}
@@ -0,0 +1,224 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from benchmarks import synthetic
+from benchmarks.run import git_commit
+
+# Load test of the API with concurrent call sessions, e.g.
+#   python -m benchmarks.loadtest --concurrency 1 4 16 64 --sessions 200 --output load.json
+#   python -m benchmarks.loadtest --url http://localhost:8080 --concurrency 8 32
+# Every session replays one call: /bluecone, then an /extract and a /similarity with the keywords
+# found so far for every utterance, then /reset. Without --url the app runs in this process.
+# The report has the latency percentiles, the throughput and the error rate per endpoint and
+# concurrency level, and the lowest level at which the p95 of an endpoint exceeds --slo-ms.
+
+ENDPOINTS = ["/bluecone", "/extract", "/similarity", "/reset"]
+
+def synthetic_sessions(grid_store, count, steps=(2, 5), seed=0):
+    """
+    Call scripts on the cells of grid_store: a cone, the caller utterances and the keywords the
+    operator has selected after each utterance (growing from one utterance to the next).
+    """
+    rng = np.random.default_rng(seed)
+    cones = synthetic.random_cones(grid_store, count, seed=seed)
+    sessions = []
+    for i, (origin, radius, angle, direction) in enumerate(cones):
+        step_count = int(rng.integers(steps[0], steps[1] + 1))
+        keyword_sets = synthetic.random_keyword_sets(grid_store, step_count, size=(1, 2), seed=seed * 100003 + i)
+        keywords = []
+        for keyword_set in keyword_sets:
+            keywords.append(list(dict.fromkeys((keywords[-1] if keywords else []) + keyword_set)))
+        sessions.append({
+            "cone": {"cone_origin": [float(origin[0]), float(origin[1])], "cone_radius": float(radius),
+                     "cone_angle": float(angle), "cone_direction": float(direction)},
+            "utterances": synthetic.random_transcripts(keyword_sets, seed=seed * 100003 + i),
+            "keywords": keywords,
+        })
+    return sessions
+
+def read_sessions(filename):
+    # one session script per line, in the format of synthetic_sessions; with "use_extracted": true
+    # the keywords found by /extract are sent to /similarity as well
+    with open(filename, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def write_sessions(sessions, filename):
+    with open(filename, 'w', encoding='utf-8') as f:
+        for session in sessions:
+            f.write(json.dumps(session, ensure_ascii=False) + "\n")
+
+class Recorder():
+    # latency and status of every request of one concurrency level
+    def __init__(self):
+        self.requests = {endpoint: [] for endpoint in ENDPOINTS}
+        self.sessions = []
+
+    async def post(self, client, endpoint, content):
+        start = time.perf_counter()
+        try:
+            response = await client.post(endpoint, json=content)
+            status = response.status_code
+        except Exception as e:
+            response, status = None, type(e).__name__
+        self.requests[endpoint].append((time.perf_counter() - start, status))
+        return response if status == 200 else None
+
+def latency_summary(latencies):
+    latencies = np.asarray(latencies) * 1000
+    if len(latencies) == 0:
+        return {}
+    return {
+        "mean_ms": float(latencies.mean()),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+def summary(recorder, duration):
+    endpoints = {}
+    for endpoint, requests in recorder.requests.items():
+        statuses = {}
+        for _, status in requests:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        errors = sum(count for status, count in statuses.items() if status != "200")
+        endpoints[endpoint] = {
+            "requests": len(requests),
+            "throughput": len(requests) / duration if duration > 0 else None,
+            "errors": errors,
+            "error_rate": errors / len(requests) if requests else None,
+            "status": statuses,
+            **latency_summary([latency for latency, status in requests if status == 200]),
+        }
+    return {
+        "duration_s": duration,
+        "sessions_per_s": len(recorder.sessions) / duration if duration > 0 else None,
+        "session": latency_summary(recorder.sessions),
+        "endpoints": endpoints,
+    }
+
+async def run_session(client, recorder, script, think_time):
+    start = time.perf_counter()
+    response = await recorder.post(client, "/bluecone", dict(script["cone"], format="compact"))
+    if response is not None:
+        call_id = response.json()["call_id"]
+        for utterance, keywords in zip(script["utterances"], script["keywords"]):
+            await asyncio.sleep(think_time)
+            response = await recorder.post(client, "/extract", {"text": utterance})
+            # the keywords the operator selected, with the extracted ones of a recorded call
+            found = response.json()["keywords"] if response is not None else []
+            keywords = list(dict.fromkeys(keywords + (found if script.get("use_extracted") else [])))
+            await recorder.post(client, "/similarity", {"call_id": call_id, "keywords": keywords, "format": "compact", "top_k": 50})
+        await recorder.post(client, "/reset", {"call_id": call_id})
+    recorder.sessions.append(time.perf_counter() - start)
+
+async def run_level(client, sessions, concurrency, think_time):
+    # concurrency callers work through the session scripts
+    recorder = Recorder()
+    queue = asyncio.Queue()
+    for script in sessions:
+        queue.put_nowait(script)
+
+    async def caller():
+        while not queue.empty():
+            await run_session(client, recorder, queue.get_nowait(), think_time)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(caller() for _ in range(concurrency)))
+    return summary(recorder, time.perf_counter() - start)
+
+async def wait_ready(client, timeout):
+    # /bluecone and /similarity need the grid store and the vectors, /extract its NLTK data
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        response = await client.get("/ready")
+        if response.json().get("status") != "loading":
+            return response.json()
+        await asyncio.sleep(0.5)
+    return {"status": "timeout"}
+
+async def run(sessions, levels, url=None, think_time=0.0, ready_timeout=300, request_timeout=60):
+    import httpx
+
+    if url is not None:
+        async with httpx.AsyncClient(base_url=url, timeout=request_timeout) as client:
+            ready = await wait_ready(client, ready_timeout)
+            return ready, {str(level): await run_level(client, sessions, level, think_time) for level in levels}
+
+    # in-process: the app with its startup and shutdown events, requests go through ASGI without sockets
+    import app.model_api as api
+
+    async with api.app.router.lifespan_context(api.app):
+        # unhandled errors of the app are answered with a 500 like by a server
+        transport = httpx.ASGITransport(app=api.app, raise_app_exceptions=False)
+        async with httpx.AsyncClient(transport=transport, base_url="http://loadtest", timeout=request_timeout) as client:
+            ready = await wait_ready(client, ready_timeout)
+            return ready, {str(level): await run_level(client, sessions, level, think_time) for level in levels}
+
+def saturation(levels, slo_ms, max_error_rate=0.01):
+    # per endpoint, the lowest concurrency whose p95 exceeds slo_ms or whose error rate exceeds max_error_rate
+    saturated = {}
+    for endpoint in ENDPOINTS:
+        saturated[endpoint] = None
+        for level, result in sorted(levels.items(), key=lambda item: int(item[0])):
+            stats = result["endpoints"][endpoint]
+            if stats.get("p95_ms", 0) > slo_ms or (stats["error_rate"] or 0) > max_error_rate:
+                saturated[endpoint] = int(level)
+                break
+    return saturated
+
+def main():
+    import app.GridStore as gs
+
+    parser = argparse.ArgumentParser(description='Load test the geohilfe API with concurrent call sessions.')
+    parser.add_argument('--url', default=None, help='base URL of a running server, the app runs in-process if not given')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16, 64], help='concurrent calls per level')
+    parser.add_argument('--sessions', type=int, default=100, help='synthetic sessions per level')
+    parser.add_argument('--scripts', default=None, help='JSON lines file of recorded session scripts instead of synthetic ones')
+    parser.add_argument('--save-scripts', default=None, help='write the synthetic session scripts to this file')
+    parser.add_argument('--grid', default=gs.GRID_PATH, help='dataset the synthetic cones and keywords are drawn from')
+    parser.add_argument('--think-ms', type=float, default=0.0, help='pause of the operator before every utterance')
+    parser.add_argument('--slo-ms', type=float, default=500.0, help='p95 latency above which operators are waiting')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='JSON file for the results, printed if not given')
+    args = parser.parse_args()
+
+    if args.scripts is not None:
+        sessions = read_sessions(args.scripts)
+    else:
+        sessions = synthetic_sessions(gs.load_grid_store(args.grid), args.sessions, seed=args.seed)
+        if args.save_scripts is not None:
+            write_sessions(sessions, args.save_scripts)
+
+    ready, levels = asyncio.run(run(sessions, args.concurrency, args.url, args.think_ms / 1000))
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "target": args.url or "in-process",
+        "ready": ready,
+        "sessions": len(sessions),
+        "think_ms": args.think_ms,
+        "slo_ms": args.slo_ms,
+        "levels": levels,
+        "saturation": saturation(levels, args.slo_ms),
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
+        print(f"results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from benchmarks import synthetic
+
+# Local stand-in for the places service of app.geo_database, for trying out and timing dataset builds
+# without API keys or quotas, e.g.
+#   python -m benchmarks.places_stub --port 8765 --replay app/geohilfe_data_aws_v2.csv
+#   python -m app.geo_database /tmp/grid.csv --url http://localhost:8765/places --rate 0
+# GET /places?bbox=<west>,<south>,<east>,<north> answers {"places": [...]} in the raw_data format.
+
+def synthetic_places(west, south, east, north, fill=0.14):
+    # the same bbox always gets the same places, so rebuilt grids can be compared
+    rng = random.Random(zlib.crc32(f'{west:.6f},{south:.6f},{east:.6f},{north:.6f}'.encode()))
+    if rng.random() >= fill:
+        return []
+
+    places = []
+    for _ in range(rng.randint(1, 6)):
+        street = f'{rng.choice(synthetic.STREET_NAMES)} {rng.choice(synthetic.STREET_TYPES)}'
+        number = str(rng.randint(1, 60))
+        name = f'{rng.choice(synthetic.LANDMARK_TYPES)} {rng.choice(synthetic.LANDMARK_NAMES)}'
+        place = {
+            'AddressNumber': number,
+            'Country': 'DEU',
+            'Geometry': {'Point': [round(rng.uniform(west, east), 5), round(rng.uniform(south, north), 5)]},
+            'Interpolated': False,
+            'Label': f"{name}, {street.replace(' ', '')} {number}, 88709, Meersburg, Baden-Württemberg, DEU",
+            'Municipality': 'Meersburg',
+            'PostalCode': '88709',
+            'Region': 'Baden-Württemberg',
+            'Street': street,
+            'SubRegion': 'Bodenseekreis',
+        }
+        # one entry per category of the place, like the v2 raw_data
+        for category in rng.sample(synthetic.CATEGORIES, rng.randint(1, 2)):
+            places.append(dict(place, Category=category))
+    return places
+
+class ReplayPlaces():
+    # answers with the raw_data places of an existing grid file that lie in the bbox
+    def __init__(self, filename):
+        from app.GridStore import read_grid_csv
+
+        self.places = [place for places in read_grid_csv(filename)['raw_data'] for place in places]
+
+    def __call__(self, west, south, east, north):
+        return [place for place in self.places
+                if west <= place['Geometry']['Point'][0] <= east and south <= place['Geometry']['Point'][1] <= north]
+
+class PlacesHandler(BaseHTTPRequestHandler):
+    # keep-alive, so the pooled connections of the client are reused
+    protocol_version = 'HTTP/1.1'
+    places = staticmethod(synthetic_places)
+    latency = 0.0
+    failure_rate = 0.0
+    random = random.Random(0)
+    lock = threading.Lock()
+
+    def send_json(self, status, content, headers=None):
+        body = json.dumps(content, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/places':
+            return self.send_json(404, {"message": "not found"})
+        try:
+            west, south, east, north = (float(i) for i in parse_qs(url.query)['bbox'][0].split(','))
+        except (KeyError, ValueError):
+            return self.send_json(400, {"message": "bbox=<west>,<south>,<east>,<north> required"})
+
+        time.sleep(self.latency)
+        with self.lock:
+            failed = self.random.random() < self.failure_rate
+        if failed:
+            # throttling answers exercise the retries of the client
+            return self.send_json(429, {"message": "rate exceeded"}, {"Retry-After": "0"})
+        self.send_json(200, {"places": self.places(west, south, east, north)})
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port=8765, replay=None, latency=0.0, failure_rate=0.0):
+    handler = type('Handler', (PlacesHandler,), {
+        "places": staticmethod(ReplayPlaces(replay) if replay else synthetic_places),
+        "latency": latency,
+        "failure_rate": failure_rate,
+    })
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    return server
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stub places service for app.geo_database builds.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--replay', default=None, help='grid file whose raw_data is served instead of synthetic places')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every answer')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of requests answered with 429')
+    args = parser.parse_args()
+
+    server = serve(args.port, args.replay, args.latency, args.failure_rate)
+    print(f"places stub listening on http://127.0.0.1:{args.port}/places")
+    server.serve_forever()
@@ -0,0 +1,158 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+import numpy as np
+
+import app.BlueConeCheck as bcc
+import app.SimilarityModel as sm
+from app.VectorStore import MmapVectors
+from benchmarks import synthetic
+
+# Benchmarks of the pipeline stages on synthetic grids, e.g.
+#   python -m benchmarks.run --cells 1000 10000 100000 --output results.json
+# Every function gets throughput, latency percentiles and the peak memory allocated while it runs,
+# results of different commits can be compared with the same arguments.
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def measure(fn, inputs, warmup=1, memory_calls=10):
+    # fn is called once per input, inputs are cycled for the warm-up calls
+    for i in range(warmup):
+        fn(*inputs[i % len(inputs)])
+
+    latencies = np.zeros(len(inputs))
+    start = time.perf_counter()
+    for i, args in enumerate(inputs):
+        call_start = time.perf_counter()
+        fn(*args)
+        latencies[i] = time.perf_counter() - call_start
+    total = time.perf_counter() - start
+
+    # tracemalloc slows down the calls, so the peak memory is taken in a separate pass
+    peak = 0
+    for args in inputs[:memory_calls]:
+        tracemalloc.start()
+        fn(*args)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    latencies *= 1000
+    return {
+        "calls": len(inputs),
+        "throughput": len(inputs) / total if total > 0 else None,
+        "mean_ms": float(latencies.mean()),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "peak_memory_bytes": int(peak),
+    }
+
+def cascade_recall(keyword_sets, nlp, grid_store, subsets, size, top_k=10):
+    # share of the top_k cells of full scoring that the cascade also ranks in its top_k
+    recalls = []
+    for keywords, subset in zip(keyword_sets, subsets):
+        expected = set(sm.score_cells(keywords, nlp, grid_store, subset, top_k)[0].tolist())
+        if len(expected) > 0:
+            found = set(sm.score_cells(keywords, nlp, grid_store, subset, top_k, cascade=size)[0].tolist())
+            recalls.append(len(expected & found) / len(expected))
+    return float(np.mean(recalls)) if recalls else None
+
+def bench_grid(cells, queries, seed, vectors_path, cascade_sizes=()):
+    results = {}
+
+    start = time.perf_counter()
+    grid_store = synthetic.generate_grid(cells, seed=seed)
+    results["generate_grid"] = {"seconds": time.perf_counter() - start}
+
+    start = time.perf_counter()
+    grid_store.spatial_index()
+    results["spatial_index"] = {"seconds": time.perf_counter() - start}
+
+    cones = synthetic.random_cones(grid_store, queries, seed=seed)
+    results["find_bc_cell"] = measure(bcc.find_bc_cell, [(grid_store, cone[0]) for cone in cones])
+    results["get_grids_subset"] = measure(bcc.get_grids_subset, [(grid_store, *cone) for cone in cones])
+
+    subsets = [bcc.get_grids_subset(grid_store, *cone) for cone in cones]
+    results["get_grids_subset"]["mean_cells"] = float(np.mean([len(subset) for subset in subsets]))
+    results["get_bbox_subset"] = measure(bcc.get_bbox_subset, [(grid_store, subset) for subset in subsets])
+
+    # the embeddings of the grid keywords are built once per store, like at the API startup
+    synthetic.synthetic_vectors(grid_store, vectors_path, seed=seed)
+    nlp = MmapVectors(vectors_path)
+    start = time.perf_counter()
+    sm.keyword_embeddings(grid_store, nlp)
+    sm.name_dictionary(grid_store)
+    results["warm_up"] = {"seconds": time.perf_counter() - start}
+
+    keyword_sets = synthetic.random_keyword_sets(grid_store, queries, seed=seed)
+    results["user_keyword_handler"] = measure(sm.user_keyword_handler, [(keywords, nlp, grid_store, subset)
+                                                                      for keywords, subset in zip(keyword_sets, subsets)])
+    results["user_keyword_handler_all_cells"] = measure(sm.user_keyword_handler, [(keywords, nlp, grid_store, None, 10)
+                                                                                for keywords in keyword_sets])
+
+    # cascade ranking of the whole grid, the recall@10 against full scoring helps to choose the shortlist size
+    all_cells = np.arange(len(grid_store))
+    for size in cascade_sizes:
+        key = f"score_cells_cascade_{size}"
+        results[key] = measure(sm.score_cells, [(keywords, nlp, grid_store, all_cells, 10, None, None, None, size)
+                                                for keywords in keyword_sets])
+        results[key]["recall_at_10"] = cascade_recall(keyword_sets, nlp, grid_store, [all_cells] * len(keyword_sets), size)
+    return results
+
+def bench_extraction(queries, seed):
+    # needs the NLTK data of load_libraries(), skipped when it is not installed
+    try:
+        import app.KeyWordExtraction as kwe
+        sw_nltk, _ = kwe.load_libraries(download=False)
+        sentences = synthetic.random_transcripts(synthetic.random_keyword_sets(synthetic.generate_grid(100, seed=seed), queries, seed=seed), seed=seed)
+        return measure(kwe.extract_keywords_from_sentence, [(sentence, sw_nltk) for sentence in sentences])
+    except (ImportError, LookupError) as e:
+        # the NLTK message is framed with asterisks, keep the line naming the missing resource
+        lines = [line.strip() for line in str(e).splitlines() if line.strip().strip('*')]
+        return {"skipped": lines[0] if lines else type(e).__name__}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the geohilfe pipeline stages on synthetic grids.')
+    parser.add_argument('--cells', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--queries', type=int, default=200, help='cones and keyword sets per grid size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--cascade', type=int, nargs='*', default=[100, 1000], help='shortlist sizes of the cascade ranking')
+    parser.add_argument('--output', default=None, help='JSON file for the results, printed if not given')
+    args = parser.parse_args()
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "queries": args.queries,
+        "seed": args.seed,
+        "grids": {},
+    }
+    with tempfile.TemporaryDirectory() as vectors_path:
+        for cells in args.cells:
+            report["grids"][str(cells)] = bench_grid(cells, args.queries, args.seed, vectors_path, args.cascade)
+    report["extract_keywords_from_sentence"] = bench_extraction(args.queries, args.seed)
+
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(output)
+        print(f"results written to {args.output}")
+
+if __name__ == '__main__':
+    main()
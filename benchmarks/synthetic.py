@@ -0,0 +1,119 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+from app.GridStore import GridStore
+from app.VectorStore import write_vectors
+
+# Synthetic grids in the schema of app/geohilfe_data_aws_v2.csv, for scaling studies beyond the 300 Meersburg cells.
+# The vocabulary mirrors the AWS Location categories, streets and landmarks of the real dataset.
+
+ORIGIN = (47.710647, 9.252200)
+CELL_M = 300
+M_PER_LAT_DEGREE = 111320.0
+
+CATEGORIES = ['School', 'Bakery', 'Hotel', 'Lodging', 'Restaurant', 'Park', 'ATM', 'Bank', 'Medical Clinic', 'Grocery',
+              'Parking', 'Police Station', 'Car Repair', 'Bar', 'Dentist', 'Library', 'Museum', 'Nightlife', 'Pharmacy',
+              'Post Office', 'Market', 'Fitness Center', 'Sports Center', 'Clothing Store', 'Coffee Shop', 'City Hall',
+              'Government Office', 'Gas Station', 'Car Wash', 'Convenience Store']
+STREET_NAMES = ['Meersburger', 'Daisendorfer', 'Stettener', 'Unteruhldinger', 'Kirch', 'Schul', 'Markt', 'Linden', 'Kronen',
+                'Schützen', 'Toren', 'Steig', 'Mesmer', 'Allmend', 'Sommertal', 'Hecht', 'Dorner', 'Winzer', 'Spital',
+                'Vorburg', 'Bismarck', 'Schloß', 'Uhland', 'Goethe', 'Schiller', 'Friedhof', 'Bahnhof', 'Berg', 'See', 'Wiesen']
+STREET_TYPES = ['straße', 'Straße', 'weg', 'gasse', 'platz', 'allee', 'halde', 'promenade']
+LANDMARK_TYPES = ['Bäckerei', 'Restaurant', 'Hotel', 'Ferienwohnung', 'Kindergarten', 'Apotheke', 'Weinhaus', 'Gasthaus',
+                  'Dr. med.', 'Haus', 'Café', 'Metzgerei', 'Autohaus', 'Getränkemarkt', 'Praxis']
+LANDMARK_NAMES = ['Mayer', 'Schön', 'Epple', 'Hanser', 'Raible', 'Grabe', 'Benfer', 'Fitzner', 'Haan', 'Korte', 'Ast',
+                  'Zifreund', 'Marcinowski', 'Boppenmaier', 'Säntisblick', 'Seeblick', 'Sonne', 'Adler', 'Löwen', 'Krone']
+CALLER_WORDS = ['church', 'supermarket', 'Kaufland', 'Rewe', 'Bahnhof', 'school', 'bakery', 'gas station', 'park', 'harbour',
+                'castle', 'vineyard', 'parking lot', 'pharmacy', 'hotel', 'bus stop']
+
+def generate_grid(cells, origin=ORIGIN, cell_m=CELL_M, fill=0.14, seed=0):
+    """
+    Tiles about `cells` 300 m cells eastwards and southwards from the north-west corner `origin`.
+    A fraction `fill` of the cells has places, like the real dataset; their keyword, street and
+    landmark lists are drawn from the vocabulary above.
+    """
+    rng = np.random.default_rng(seed)
+    columns = int(math.ceil(math.sqrt(cells)))
+    row = np.arange(cells) // columns
+    column = np.arange(cells) % columns
+
+    lat_step = cell_m / M_PER_LAT_DEGREE
+    lon_step = cell_m / (M_PER_LAT_DEGREE * math.cos(math.radians(origin[0])))
+    northeast = np.column_stack([origin[0] - row * lat_step, origin[1] + (column + 1) * lon_step])
+    southwest = np.column_stack([origin[0] - (row + 1) * lat_step, origin[1] + column * lon_step])
+
+    keywords, streets, landmarks = [], [], []
+    for filled in rng.random(cells) < fill:
+        if not filled:
+            keywords.append([])
+            streets.append([])
+            landmarks.append([])
+            continue
+
+        places = int(rng.integers(1, 12))
+        keywords.append(list(dict.fromkeys(rng.choice(CATEGORIES, places).tolist())))
+        streets.append(list(dict.fromkeys(f'{rng.choice(STREET_NAMES)}{rng.choice(STREET_TYPES)}' for _ in range(max(places // 2, 1)))))
+        landmarks.append([f'{rng.choice(LANDMARK_TYPES)} {rng.choice(LANDMARK_NAMES)}' for _ in range(places)])
+
+    grid_cells = pd.DataFrame({
+        "grid_num": np.arange(1, cells + 1),
+        "northeast": [tuple(point) for point in northeast.tolist()],
+        "southwest": [tuple(point) for point in southwest.tolist()],
+        "keywords": keywords,
+        "streets": streets,
+        "landmarks": landmarks,
+    })
+    return GridStore.from_dataframe(grid_cells, version=f'synthetic-{cells}-{seed}')
+
+def write_grid_csv(grid_store, filename):
+    # same columns and tab separated layout as the AWS dataset, the raw place data is left empty
+    rows = []
+    for i in range(len(grid_store)):
+        cell = grid_store.cell(i)
+        rows.append([cell["grid_num"], cell["northeast"], cell["southwest"], [], cell["keywords"], [],
+                     cell["landmarks"], [], cell["streets"]])
+    columns = ["grid_num", "northeast", "southwest", "raw_data", "keywords", "addresses", "landmarks", "subregion", "streets"]
+    pd.DataFrame(rows, columns=columns).to_csv(filename, sep='\t')
+
+def random_cones(grid_store, count, seed=0):
+    # (origin, radius, angle, direction) with the tower inside the grid
+    rng = np.random.default_rng(seed)
+    cells = rng.integers(0, len(grid_store), count)
+    cones = []
+    for cell in cells:
+        origin = tuple(float(i) for i in rng.uniform(grid_store.southwest[cell], grid_store.northeast[cell]))
+        cones.append((origin, float(rng.choice([500, 1000, 2000, 5000])), float(rng.choice([30, 60, 90, 120])),
+                      float(rng.uniform(0, 360))))
+    return cones
+
+def random_keyword_sets(grid_store, count, size=(1, 6), seed=0):
+    # keyword sets like operators send them: grid names, categories and free caller words
+    rng = np.random.default_rng(seed)
+    vocabulary = [grid_store.streets.names, grid_store.landmarks.names, CATEGORIES, CALLER_WORDS]
+    keyword_sets = []
+    for _ in range(count):
+        keywords = []
+        for _ in range(int(rng.integers(size[0], size[1] + 1))):
+            words = vocabulary[int(rng.integers(len(vocabulary)))] or CALLER_WORDS
+            keywords.append(str(words[int(rng.integers(len(words)))]))
+        keyword_sets.append(keywords)
+    return keyword_sets
+
+def random_transcripts(keyword_sets, seed=0):
+    rng = np.random.default_rng(seed)
+    templates = ['I am next to the {} and I can see {}.', 'There is a {} about 200 meters from {}.',
+                 'We are on {} near the {}.', 'Please hurry, my father collapsed near {} by the {}.']
+    return [templates[int(rng.integers(len(templates)))].format(keywords[0], keywords[-1]) for keywords in keyword_sets]
+
+def synthetic_vectors(grid_store, path, dim=300, seed=0):
+    """
+    Random word vectors for every token of the grid vocabulary and the caller words, in the
+    MmapVectors format. It exercises the scoring path when no exported spaCy vectors are at hand.
+    """
+    rng = np.random.default_rng(seed)
+    texts = (grid_store.keywords.names + grid_store.streets.names + grid_store.landmarks.names + CATEGORIES + CALLER_WORDS)
+    words = sorted({token for text in texts for token in text.split()})
+    vectors = rng.normal(size=(len(words), dim)).astype(np.float32)
+    write_vectors(words, list(range(len(words))), vectors, path, pipeline=f'synthetic-{dim}')
@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+
+import pytest
+import requests
+
+import app.geo_database as gd
+from app.GridStore import read_grid_csv
+from benchmarks import places_stub
+
+# Dataset builds against the local places stub (benchmarks/places_stub.py), no network or API key needed.
+
+COLUMNS = 4
+ROWS = 5
+
+@pytest.fixture
+def places_server():
+    # started on a free port, failure_rate can be changed by the tests while it runs
+    servers = []
+
+    def start(failure_rate=0.0):
+        server = places_stub.serve(port=0, failure_rate=failure_rate)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, f"http://127.0.0.1:{server.server_address[1]}/places"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+class CountingClient(gd.PlacesClient):
+    # counts the fetched cells and fails after interrupt_after of them, like a killed build
+    def __init__(self, *args, interrupt_after=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.interrupt_after = interrupt_after
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def fetch(self, northeast, southwest):
+        with self.lock:
+            if self.interrupt_after is not None and len(self.fetched) >= self.interrupt_after:
+                raise RuntimeError("build interrupted")
+            self.fetched.append((tuple(northeast), tuple(southwest)))
+        return super().fetch(northeast, southwest)
+
+def build(filename, client, workers=4):
+    return gd.build_dataset(str(filename), client, columns=COLUMNS, rows=ROWS, workers=workers)
+
+def test_build_writes_every_cell_once(places_server, tmp_path):
+    _, url = places_server()
+    client = CountingClient(url, rate=0)
+    assert build(tmp_path / 'grid.csv', client) == COLUMNS * ROWS
+
+    grid = read_grid_csv(tmp_path / 'grid.csv')
+    assert grid['grid_num'].tolist() == list(range(1, COLUMNS * ROWS + 1))
+    assert len(client.fetched) == COLUMNS * ROWS
+    assert not os.path.exists(tmp_path / 'grid.csv.checkpoint')
+
+def test_throttled_requests_are_retried(places_server, tmp_path):
+    _, url = places_server(failure_rate=0.3)
+    client = gd.PlacesClient(url, rate=0, retries=20, backoff=0)
+    assert build(tmp_path / 'grid.csv', client) == COLUMNS * ROWS
+
+    # the answers of the stub only depend on the bbox, so the retried build is the same as a clean one
+    _, clean_url = places_server()
+    build(tmp_path / 'clean.csv', gd.PlacesClient(clean_url, rate=0))
+    assert (tmp_path / 'grid.csv').read_text(encoding='utf-8') == (tmp_path / 'clean.csv').read_text(encoding='utf-8')
+
+def test_retries_give_up(places_server, tmp_path):
+    _, url = places_server(failure_rate=1.0)
+    client = gd.PlacesClient(url, rate=0, retries=2, backoff=0)
+    with pytest.raises(requests.HTTPError):
+        client.fetch((47.71, 9.26), (47.70, 9.25))
+
+def test_interrupted_build_resumes(places_server, tmp_path):
+    _, url = places_server()
+    filename = tmp_path / 'grid.csv'
+    checkpoint = tmp_path / 'grid.csv.checkpoint'
+
+    with pytest.raises(RuntimeError):
+        build(filename, CountingClient(url, rate=0, interrupt_after=9), workers=1)
+    finished = gd.read_checkpoint(str(checkpoint))
+    assert 0 < len(finished) < COLUMNS * ROWS
+    assert not os.path.exists(filename)
+
+    # a partly written line of the killed build is skipped
+    with open(checkpoint, 'a', encoding='utf-8') as f:
+        f.write('{"grid_num": 1')
+
+    client = CountingClient(url, rate=0)
+    assert build(filename, client) == COLUMNS * ROWS
+    assert len(client.fetched) == COLUMNS * ROWS - len(finished)
+
+    grid = read_grid_csv(filename)
+    assert grid['grid_num'].tolist() == list(range(1, COLUMNS * ROWS + 1))
+    build(tmp_path / 'clean.csv', gd.PlacesClient(url, rate=0))
+    assert filename.read_text(encoding='utf-8') == (tmp_path / 'clean.csv').read_text(encoding='utf-8')
+
+def test_rate_limiter():
+    limiter = gd.RateLimiter(50)
+    start = time.monotonic()
+    for _ in range(11):
+        limiter.acquire()
+    # the first acquisition is immediate, the next ten are 20 ms apart
+    assert time.monotonic() - start >= 0.19